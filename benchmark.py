@@ -0,0 +1,158 @@
+"""
+Scaling benchmark for the simulation engines in this folder.
+
+Each engine is loaded headless (the scripts only plot under
+``if __name__ == "__main__"``), built at increasing flock sizes N and
+stepped until a minimum wall time has passed. For every (engine, N) it
+records steps per second and the peak memory traced over a few extra steps, then
+fits the scaling exponent b of time-per-step ~ N^b, so an O(N^2) path shows
+up as b close to 2. Results are appended to a JSON file, one entry per run,
+so numbers from different versions of the code can be compared.
+
+The box grows with N to keep the density of the original demos (30 boids
+in the p5 scripts' default box, 50 boids in 300x300 for boidflock),
+otherwise large N would just measure a solid clump.
+
+    python benchmark.py
+    python benchmark.py --engines boidflock --sizes 50 500 5000 50000
+"""
+import argparse
+import json
+import os
+import runpy
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SIZES = [50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000]
+
+
+def load(script):
+    """Runs one of the scripts for its definitions only and returns its globals."""
+    return runpy.run_path(os.path.join(HERE, script), run_name='benchmark')
+
+
+def p5engine(script, base):
+    """Factory for a p5 Flock script: (N, seed) -> step function."""
+    ns = load(script)
+
+    def build(n, seed):
+        side = base * np.sqrt(n / 30)
+        flock = ns['Flock'](n, width=side, height=side, seed=seed)
+        return flock.run
+    return build
+
+
+def boidflockengine():
+    """Factory for boidflock from boidflock.py: (N, seed) -> step function."""
+    ns = load('boidflock.py')
+
+    def build(n, seed):
+        side = 300 * np.sqrt(n / 50)
+        flock = ns['seeded_flock'](n, seed, w=side, h=side)
+        return lambda: flock.update1(flock.time)
+    return build
+
+
+# name -> (loader returning a (N, seed) -> step factory, largest N to try)
+ENGINES = {
+    'test sim 1': (lambda: p5engine('boids test sim 1.py', 300), 5000),
+    'test sim 2': (lambda: p5engine('boids test sim 2.py', 200), 5000),
+    'kuramoto': (lambda: p5engine('boids with kuramoto2.0.py', 300), 5000),
+    'boidflock': (boidflockengine, 100000),
+}
+
+
+def measure(step, min_time, max_steps, memory_steps=3):
+    """
+    Steps until min_time seconds or max_steps steps; returns (steps/s, peak
+    bytes). Allocation tracing slows allocation-heavy steps several times
+    over, so the timed pass runs without it and the peak comes from a
+    separate pass of memory_steps steps under tracemalloc.
+    """
+    step()  # warm-up: first neighbor build, imports, caches
+    steps = 0
+    start = time.perf_counter()
+    while True:
+        step()
+        steps += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or steps >= max_steps:
+            break
+    tracemalloc.start()
+    try:
+        for _ in range(memory_steps):
+            step()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return steps / elapsed, peak
+
+
+def exponent(sizes, rates):
+    """Least-squares slope of log(time per step) against log(N)."""
+    if len(sizes) < 2:
+        return None
+    return float(np.polyfit(np.log(sizes), -np.log(rates), 1)[0])
+
+
+def revision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                             capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES)
+    parser.add_argument('--min-time', type=float, default=1.0, help='seconds of stepping per point')
+    parser.add_argument('--max-steps', type=int, default=200)
+    parser.add_argument('--budget', type=float, default=30.0,
+                        help='stop growing N for an engine once one step takes longer than this')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=os.path.join(HERE, 'benchmark_results.json'))
+    args = parser.parse_args(argv)
+
+    run = {'revision': revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': sys.version.split()[0], 'numpy': np.__version__, 'engines': {}}
+    for name in args.engines:
+        loader, cap = ENGINES[name]
+        try:
+            build = loader()
+        except Exception as e:  # e.g. p5 not installed or no display
+            print(f"{name}: skipped ({type(e).__name__}: {e})")
+            run['engines'][name] = {'skipped': f"{type(e).__name__}: {e}"}
+            continue
+        points = []
+        for n in sorted(s for s in args.sizes if s <= cap):
+            rate, peak = measure(build(n, args.seed), args.min_time, args.max_steps)
+            points.append({'n': n, 'steps_per_s': rate, 'peak_bytes': peak})
+            print(f"{name:>12}  N={n:<7d} {rate:10.2f} steps/s  peak {peak / 2**20:9.1f} MiB")
+            if 1 / rate > args.budget:
+                break
+        b = exponent([p['n'] for p in points], [p['steps_per_s'] for p in points])
+        run['engines'][name] = {'points': points, 'exponent': b}
+        if b is not None:
+            print(f"{name:>12}  time per step ~ N^{b:.2f}")
+
+    history = []
+    if os.path.exists(args.output):
+        with open(args.output) as f:
+            history = json.load(f)
+    history.append(run)
+    with open(args.output, 'w') as f:
+        json.dump(history, f, indent=1)
+    print(f"Results appended to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2224 @@
+"""
+The boids-with-fireflies simulation as an importable library: the boidflock
+engine, the analysis helpers (entropy, metrics, trajectories) and the
+headless renderer. Importing it runs nothing and pulls in only numpy and
+scipy; matplotlib is imported only when a plot is asked for. The notebook
+demo lives in `final version`.
+
+Run headless from the command line with a JSON config and/or flags:
+
+    python boidflock.py --n 500 --frames 2000 --trajectory run.npy --entropy entropy.csv
+    python boidflock.py --config run.json --video run.mp4
+"""
+import itertools
+import json
+import hashlib
+import os
+import subprocess
+import time
+import contextlib
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from scipy.spatial import Voronoi
+import scipy.spatial
+import scipy.sparse
+
+
+def scale_rows(v, length):
+    """
+    Rescales every non-zero row of v to the given length (a scalar or one
+    value per row); zero rows stay zero.
+    """
+    norms = np.linalg.norm(v, axis=1)
+    length = np.broadcast_to(length, norms.shape)
+    out = np.zeros_like(v)
+    nz = norms > 0
+    out[nz] = v[nz] / norms[nz, None] * length[nz, None]
+    return out
+
+
+def clamp_rows(v, limit):
+    """Shrinks, in place, every row of v longer than limit (a scalar or one value per row)."""
+    norms = np.linalg.norm(v, axis=1)
+    limit = np.broadcast_to(limit, norms.shape)
+    over = norms > limit
+    v[over] = v[over] / norms[over, None] * limit[over, None]
+
+
+def perrow(value, rows):
+    """value[rows] for a per-boid parameter array, the value itself for a scalar."""
+    return value[rows] if np.ndim(value) else value
+
+
+def csrfromrows(rows, ghosts, real, image, n):
+    """
+    Packs row-sorted (boid, ghost neighbor) pairs into int32 CSR arrays:
+    offsets, real neighbor indices, and the int8 pen() image of each neighbor.
+    real and image map every ghost point back to the boid it copies.
+    """
+    offsets = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(np.bincount(rows, minlength=n), out=offsets[1:])
+    return offsets, real[ghosts].astype(np.int32), image[ghosts].astype(np.int8)
+
+
+# pen() image code for a periodic wrap of (-1, 0, 1) boxes in x and y
+IMAGECODE = np.array([
+    [6, 4, 1],
+    [7, 0, 2],
+    [8, 5, 3],
+], dtype=np.int8)
+
+# In 3D, a z wrap of (-1, 0, 1) boxes adds 18, 0 or 9 to the x/y image code
+ZCODE = np.array([18, 0, 9], dtype=np.int8)
+
+def imagecode(wraps):
+    """Image code of each row of integer box wraps (-1, 0 or 1 per axis), as used by shifts()."""
+    code = IMAGECODE[wraps[:, 0] + 1, wraps[:, 1] + 1]
+    if wraps.shape[1] == 3:
+        code = code + ZCODE[wraps[:, 2] + 1]
+    return code
+
+# What boidflock.stage() hands out when no profiler is attached
+NOSTAGE = contextlib.nullcontext()
+
+
+class boidflock:
+    """
+    Manages the state and updates for a flock of boids with advanced neighbor-finding
+    and phase synchronization. This version is optimized to run faster by updating
+    neighbor lists intermittently.
+
+    Positions and velocities may be (n, 2) or (n, 3); a 3D flock lives in a
+    periodic w x h x depth box and takes its alignment/cohesion neighbors
+    from the periodic KD-tree instead of Voronoi.
+
+    The state arrays may hold more rows than `number`: the extra rows are
+    read-only halo boids (see domainstrip) that can appear as neighbors but
+    are never steered or integrated.
+    """
+    def __init__(self, c, v, kus, ooo, n=15, w=300, h=300, dt=.05,
+                 radiusvel=40, radiuscohe=40, rradiusrep=30,
+                 angle=np.pi/4, alignp=1.0, cenp=1.0, repp=2.0, margin=None,
+                 skin=None, topok=None, dtype=np.float64, depth=None, nearest=None,
+                 adaptive=False):
+
+        # --- Core Properties ---
+        # dtype=np.float32 halves the memory traffic of the state, the force
+        # kernels and recorded frames; see drift_check for what it costs.
+        self.dtype = np.dtype(dtype)
+        self.posv = c.astype(self.dtype)
+        self.velv = v.astype(self.dtype)
+        self.acc = np.zeros_like(self.posv)
+        self.number = n
+        self.width = w
+        self.height = h
+        self.dim = self.posv.shape[1]
+        self.depth = (w if depth is None else depth) if self.dim == 3 else None
+        self.time = dt
+
+        # --- Behavior Parameters ---
+        self.maxvel = 100.0
+        self.maxacc = 100.0
+        self.alignp = alignp
+        self.cenp = cenp
+        self.repp = repp
+
+        # --- Neighbor Finding Parameters ---
+        self.angle = angle
+        self.rr = rradiusrep
+        self.topok = topok # Repel from the topok nearest boids instead of everyone within rr
+        # Align and cohere with the `nearest` closest boids (periodic KD-tree)
+        # instead of the Voronoi neighbors. 3D always does, 3D Voronoi being
+        # far too costly; 7 is about what starlings track.
+        self.nearest = 7 if nearest is None and self.dim == 3 else nearest
+
+        # --- Kuramoto Model Properties ---
+        self.theta = kus.astype(self.dtype)
+        self.omega = ooo.astype(self.dtype)
+        # Keep theta in [0, 2pi): an ever-growing float32 phase loses the
+        # digits that matter. float64 runs keep the raw accumulated phase.
+        self.wrap_phases = self.dtype != np.float64
+        self.kuramoto_matrix = None # Row-normalized sparse adjacency of voronoi_neighbors
+        self.order_r = 0.0          # Global order parameter |<e^{i theta}>| after the last update
+        self.local_r = np.zeros(n, dtype=self.dtype)  # Same, averaged over each boid's neighbors only
+        self.order_history = None   # Set to a list to have update1 append order_r to it every frame
+        self.metrics = None         # flockmetrics sampled at the end of every update1
+        self.rng = None             # np.random.Generator the initial conditions came from
+        self.profiler = None        # stageprofiler timing the stages of update1
+
+        # --- Optimization Properties ---
+        self.frame_count = -1 # Start at -1 so the first frame always runs a full update
+        self.recalc_interval = 2 # How often to recalculate expensive neighbor lists
+        # Verlet skin: when set, repulsion lists are built out to rr + skin and
+        # rebuilt as soon as some boid has moved more than skin / 2 since the
+        # last rebuild, i.e. once a pair could have closed the skin. The skin
+        # says nothing about Voronoi topology or the view cone, so
+        # recalc_interval stays an upper bound on how stale those get.
+        self.skin = skin
+        self.rebuild_frame = -1   # frame_count at the last neighbor rebuild
+        self.displacement = np.zeros_like(self.posv) # Unwrapped motion since last rebuild
+        self.rebuilds = 0         # Neighbor rebuilds performed
+        self.rebuilds_skipped = 0 # Steps that reused the cached neighbor lists
+        self.voronoi_neighbors = None # Cached (offsets, indices, images) neighbor arrays
+        self.repel_neighbors = None   # Cached (offsets, indices, images) neighbor arrays
+        # Adaptive substepping: update1(dt) still advances exactly dt, but in
+        # as many Euler substeps as the bounds below ask for, each reusing the
+        # cached neighbor lists. Lets dt (the output interval) grow, so fewer
+        # neighbor rebuilds cover the same simulated time.
+        self.adaptive = adaptive
+        self.substep_dv = 25.0     # Largest velocity change of any boid in one substep
+        self.substep_dphase = 1.0  # Largest phase drift of any boid relative to the mean, per substep
+        self.max_substeps = 64     # Per update1; the last one takes whatever time is left
+        self.substeps = 0          # Substeps taken so far
+
+        # --- Periodic Ghost Band ---
+        # Only boids within `margin` of a border get periodic copies. None sizes
+        # it at two mean cell spacings, 2 * sqrt(w * h / n) (see bandmargin);
+        # with certify_band on, the band is widened until every real boid's
+        # Voronoi cell is provably the same as in the full 9x pen() construction.
+        self.margin = margin
+        self.certify_band = True
+        self.band_margin = None  # Margin actually used by the last rebuild
+        self.band_points = 0     # Number of points handed to Qhull at the last rebuild
+
+        self.boidsx = self.posv[:, 0]
+        self.boidsy = self.posv[:, 1]
+
+    def pen(self):
+        """
+        Purpose: To handle periodic boundary conditions (screen wrapping).
+        It creates 8 'ghost' copies of the entire flock around the central
+        simulation area. This allows a boid near an edge to 'see' and react
+        to boids on the opposite edge as if the space were continuous.
+        """
+        p = self.posv
+        w, h = self.width, self.height
+        return np.vstack([
+            p,
+            p + [-w, h], p + [0, h], p + [w, h],
+            p + [-w, 0],           p + [w, 0],
+            p + [-w,-h], p + [0,-h], p + [w,-h]
+        ])
+
+    def shifts(self):
+        """
+        Purpose: The 9 translation vectors used by pen(), in the same order,
+        so ghost index g is real boid g % n shifted by shifts()[g // n].
+        A 3D flock has 27, indexed by imagecode().
+        """
+        w, h = self.width, self.height
+        sh = np.array([
+            [0, 0],
+            [-w, h], [0, h], [w, h],
+            [-w, 0],         [w, 0],
+            [-w,-h], [0,-h], [w,-h]
+        ], dtype=self.dtype)
+        if self.dim == 3:
+            # The same 9 at z offsets 0, +depth and -depth (see imagecode)
+            sh = np.vstack([np.column_stack([sh, np.full(9, z, dtype=self.dtype)])
+                            for z in (0, self.depth, -self.depth)])
+        return sh
+
+    def penband(self, margin):
+        """
+        Purpose: Like pen(), but only copies the boids lying within `margin`
+        of the border opposite each shift, so a boid in the middle of the box
+        is never replicated. Returns the points plus, for every point, the
+        real boid it copies and its pen() image code. A margin as wide as the
+        box falls back to the full 9x pen() layout.
+        """
+        n = self.number
+        w, h = self.width, self.height
+        if margin >= min(w, h):
+            return self.pen(), np.tile(np.arange(n), 9), np.repeat(np.arange(9), n)
+        x, y = self.posv[:, 0], self.posv[:, 1]
+        xside = {-1: x > w - margin, 0: np.ones(n, dtype=bool), 1: x < margin}
+        yside = {-1: y > h - margin, 0: np.ones(n, dtype=bool), 1: y < margin}
+        sh = self.shifts()
+        reals, images = [np.arange(n)], [np.zeros(n, dtype=np.int64)]
+        for code in range(1, 9):
+            sx, sy = np.sign(sh[code]).astype(int)
+            inband = xside[sx] & yside[sy]
+            idx = np.flatnonzero(inband)
+            reals.append(idx)
+            images.append(np.full(idx.size, code))
+        real = np.concatenate(reals)
+        image = np.concatenate(images)
+        return self.posv[real] + sh[image], real, image
+
+    def bandmargin(self):
+        """
+        Purpose: The starting ghost-band width: the user's margin if given,
+        otherwise a couple of average Voronoi cell widths.
+        """
+        if self.margin is not None:
+            return self.margin
+        return 2.0 * np.sqrt(self.width * self.height / self.number)
+
+    def bandcertified(self, g, margin):
+        """
+        Purpose: Checks that a ghost-band Voronoi diagram gives every real
+        boid exactly the neighbors the full periodic tiling would. Each vertex
+        of a real boid's cell is the center of an empty circle through it;
+        if all those circles fit inside the region the band covers, nothing
+        outside the band could change the cell.
+        """
+        rp = g.ridge_points
+        mine = (rp < self.number).any(axis=1)
+        rv = np.asarray(g.ridge_vertices)[mine]
+        if rv.size == 0 or (rv < 0).any():
+            return False
+        v = g.vertices[rv]
+        r = np.linalg.norm(v - g.points[rp[mine]], axis=2)[..., None]
+        lo = (v - r).min(axis=(0, 1))
+        hi = (v + r).max(axis=(0, 1))
+        rlo, rhi = self.bandregion(margin)
+        return (lo >= rlo).all() and (hi <= rhi).all()
+
+    def bandregion(self, margin):
+        """Purpose: Lower and upper corners of the region a ghost band of this margin covers."""
+        return (np.array([-margin, -margin]),
+                np.array([self.width + margin, self.height + margin]))
+
+    def neigh1(self, g, real=None, image=None):
+        """
+        Purpose: To find the 'topological' neighbors for each boid using a
+        Voronoi tessellation. Boids that share a boundary in the Voronoi
+        diagram are considered immediate neighbors. Returns a flat
+        (offsets, indices, images) neighbor array with ghost indices already
+        mapped back to real boids; images says which pen() copy was hit.
+        real/image describe the point layout and default to the full pen().
+        """
+        if real is None:
+            real = np.tile(np.arange(self.number), 9)
+            image = np.repeat(np.arange(9), self.number)
+        ridge_points = g.ridge_points
+        src = ridge_points.ravel()
+        dst = ridge_points[:, ::-1].ravel()
+        mine = src < self.number
+        src, dst = src[mine], dst[mine]
+        order = np.argsort(src, kind='stable')
+        return csrfromrows(src[order], dst[order], real, image, self.number)
+
+    def rawneighbors(self, margin):
+        """
+        Purpose: Builds the unfiltered Voronoi and repulsion neighbor arrays
+        from a ghost band of the given width, widening the band while
+        certify_band is on and some cell could still be wrong. With `nearest`
+        set (always in 3D) both come from one periodic KD-tree instead.
+        """
+        if self.nearest is not None:
+            with self.stage('kdtree_build'):
+                tree = self.periodictree()
+            with self.stage('kdtree_nearest'):
+                nearest = self.treeneighbors(tree, k=self.nearest)
+            return nearest, self.repelneighbors(tree)
+        full = min(self.width, self.height)
+        while True:
+            with self.stage('penband'):
+                points, real, image = self.penband(margin)
+            with self.stage('voronoi'):
+                g = Voronoi(points)
+            if margin >= full or not self.certify_band:
+                break
+            with self.stage('bandcertified'):
+                certified = self.bandcertified(g, margin)
+            if certified:
+                break
+            margin = min(2 * margin, full)
+        self.band_margin = margin
+        self.band_points = len(points)
+        with self.stage('neigh1'):
+            voronoi = self.neigh1(g, real, image)
+        return voronoi, self.repelneighbors()
+
+    def boxsize(self):
+        """Purpose: The periodic box as an array, (w, h) or (w, h, depth)."""
+        if self.dim == 3:
+            return np.array([self.width, self.height, self.depth], dtype=np.float64)
+        return np.array([self.width, self.height], dtype=np.float64)
+
+    def periodictree(self):
+        """
+        Purpose: A KD-tree over the N real boids in a periodic box, so
+        neighbor queries wrap around the edges without any ghost copies.
+        """
+        box = self.boxsize()
+        p = np.mod(self.posv, box)
+        p[p >= box] = 0  # x % w can round up to exactly w for tiny negative x
+        return scipy.spatial.cKDTree(p, boxsize=box)
+
+    def treeneighbors(self, tree, radius=None, k=None):
+        """
+        Purpose: Neighbor arrays from a periodictree(): everything within
+        radius, or the k nearest boids whatever their distance. Self-pairs
+        are left out. Returns the usual (offsets, indices, images) arrays,
+        with each image taken from the minimum-image displacement.
+        """
+        n = self.number
+        if k is None:
+            pairs = tree.query_pairs(radius, output_type='ndarray')
+            rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+            cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+        else:
+            _, idx = tree.query(tree.data, k=k + 1)
+            idx = idx.reshape(n, -1)
+            notself = idx != np.arange(n)[:, None]
+            # Keep the first k matches that are not the boid itself
+            keep = notself & (np.cumsum(notself, axis=1) <= k) & (idx < n)
+            rows, cols = np.nonzero(keep)[0], idx[keep]
+        order = np.argsort(rows, kind='stable')
+        rows, cols = rows[order], cols[order]
+        wraps = -np.round((self.posv[cols] - self.posv[rows]) / self.boxsize()).astype(int)
+        offsets = np.zeros(n + 1, dtype=np.int32)
+        np.cumsum(np.bincount(rows, minlength=n), out=offsets[1:])
+        return offsets, cols.astype(np.int32), imagecode(wraps)
+
+    def repelneighbors(self, tree=None):
+        """
+        Purpose: Finds the repulsion neighbors with the periodic KD-tree:
+        everything within rr (+ skin), or with topok set, the topok nearest
+        boids whatever their distance (the fixed-k 'topological' rule seen in
+        starling flocks). A tree already built for this step can be passed in.
+        """
+        if tree is None:
+            with self.stage('kdtree_build'):
+                tree = self.periodictree()
+        with self.stage('kdtree_query'):
+            if self.topok is None:
+                return self.treeneighbors(tree, radius=self.rr + (self.skin or 0))
+            return self.treeneighbors(tree, k=self.topok)
+
+    def checkband(self, margin=None):
+        """
+        Purpose: Compares the ghost-band neighbor sets against the full 9x
+        pen() construction for the current positions. Returns True when every
+        boid has the same Voronoi neighbors (and images) in both.
+        """
+        if margin is None:
+            margin = self.bandmargin()
+        saved = self.band_margin, self.band_points
+        band = self.rawneighbors(margin)
+        full = self.rawneighbors(np.inf)
+        self.band_margin, self.band_points = saved
+
+        def pairs(u):
+            offsets, indices, images = u
+            rows = np.repeat(np.arange(self.number), np.diff(offsets))
+            return set(zip(rows.tolist(), indices.tolist(), images.tolist()))
+
+        return pairs(band[0]) == pairs(full[0])
+
+    def dotfilter1(self, u):
+        """
+        Purpose: To filter a list of neighbors (from Voronoi) to include only
+        those within the boid's forward field of view. This makes the
+        simulation more realistic as boids don't react to neighbors behind them.
+        The cone test is one dot-product mask over every ridge pair.
+        """
+        offsets, indices, images = u
+        rows = np.repeat(np.arange(self.number, dtype=np.int32), np.diff(offsets))
+        vec_to_neighbor = self.neighborpos(indices, images) - self.posv[rows]
+        dist = np.linalg.norm(vec_to_neighbor, axis=1)
+        speed = np.linalg.norm(self.velv, axis=1)[rows]
+        dot_product = np.einsum('ij,ij->i', self.velv[rows], vec_to_neighbor)
+        cos_angle = dot_product / (speed * dist + 1e-9)
+        keep = (speed > 0) & (dist > 0) & (cos_angle > np.cos(self.angle))
+        offsets = np.zeros(self.number + 1, dtype=np.int32)
+        np.cumsum(np.bincount(rows[keep], minlength=self.number), out=offsets[1:])
+        return offsets, indices[keep], images[keep]
+
+    def neighborpos(self, indices, images, rows=None):
+        """
+        Purpose: Positions of neighbors as seen through their periodic image.
+        With a skin or adaptive substeps a boid can wrap around the box
+        between rebuilds, which makes its cached image stale, so the image
+        nearest to boid rows is used instead.
+        """
+        if (self.skin is None and not self.adaptive) or rows is None:
+            return self.posv[indices] + self.shifts()[images]
+        d = self.posv[indices] - self.posv[rows]
+        box = self.boxsize().astype(self.dtype)
+        return self.posv[rows] + d - box * np.round(d / box)
+
+    def segmean(self, values, rows, counts):
+        """
+        Purpose: Averages per-neighbor values over each boid's segment of a
+        flat neighbor array with one bincount per column instead of a Python
+        loop. Boids with no neighbors get zeros.
+        """
+        sums = np.zeros((self.number, values.shape[1]), dtype=values.dtype)
+        for k in range(values.shape[1]):
+            sums[:, k] = np.bincount(rows, weights=values[:, k], minlength=self.number)
+        has = counts > 0
+        sums[has] /= counts[has, None]
+        return sums
+
+    def krepel1111(self, u):
+        """
+        Purpose: To calculate the separation (repulsion) force. Each boid
+        steers away from the average position of its very close neighbors
+        (found with a KD-Tree) to avoid crowding. With a skin the cached list
+        reaches out to rr + skin, so neighbors are cut back to rr here.
+        """
+        offsets, indices, images = u
+        rows = np.repeat(np.arange(self.number), np.diff(offsets))
+        away = self.posv[rows] - self.neighborpos(indices, images, rows)
+        keep = (indices != rows) | (images != 0)
+        if self.skin is not None and self.topok is None:
+            keep &= np.linalg.norm(away, axis=1) <= perrow(self.rr, rows)
+        rows, away = rows[keep], away[keep]
+        counts = np.bincount(rows, minlength=self.number)
+        desvel = self.segmean(away, rows, counts)
+        has = np.linalg.norm(desvel, axis=1) > 0
+        stoor = np.zeros((self.number, self.dim), dtype=self.dtype)
+        steer = scale_rows(desvel, self.maxvel) - self.velv[:self.number]
+        stoor[has] = scale_rows(steer, self.maxacc)[has]
+        return stoor
+
+    def kvelalign1111(self, u):
+        """
+        Purpose: To calculate the alignment force. Each boid steers to match
+        the average velocity of its local (Voronoi) neighbors.
+        """
+        offsets, indices, images = u
+        counts = np.diff(offsets)
+        rows = np.repeat(np.arange(self.number), counts)
+        desvel = self.segmean(self.velv[indices], rows, counts)
+        has = counts > 0
+        stoor = np.zeros((self.number, self.dim), dtype=self.dtype)
+        stoor[has] = scale_rows(desvel - self.velv[:self.number], self.maxacc)[has]
+        return stoor
+
+    def kcenter1111(self, u):
+        """
+        Purpose: To calculate the cohesion force. Each boid steers towards the
+        average position (center of mass) of its local (Voronoi) neighbors.
+        """
+        offsets, indices, images = u
+        counts = np.diff(offsets)
+        rows = np.repeat(np.arange(self.number), counts)
+        center_pos = self.segmean(self.neighborpos(indices, images, rows), rows, counts)
+        has = counts > 0
+        stoor = np.zeros((self.number, self.dim), dtype=self.dtype)
+        stoor[has] = scale_rows(center_pos - self.posv[:self.number], self.maxacc)[has]
+        return stoor
+
+    def flockforces(self, repel, voronoi):
+        """
+        Purpose: The batched force engine. Computes separation, alignment and
+        cohesion for the whole flock from flat neighbor arrays.
+        """
+        with self.stage('krepel1111'):
+            w = self.krepel1111(repel)
+        with self.stage('kvelalign1111'):
+            q = self.kvelalign1111(voronoi)
+        with self.stage('kcenter1111'):
+            b = self.kcenter1111(voronoi)
+        return w, q, b
+
+    def kuramotomatrix(self, u):
+        """
+        Purpose: Builds the sparse adjacency of a neighbor array with each row
+        scaled by 1 / neighbor count, so A @ z averages z over the neighbors.
+        """
+        offsets, indices, images = u
+        counts = np.diff(offsets)
+        weights = np.repeat((1.0 / np.maximum(counts, 1)).astype(self.dtype), counts)
+        return scipy.sparse.csr_matrix((weights, indices, offsets), shape=(self.number, len(self.theta)))
+
+    def kthetaupdate111(self, dt, u, k=0.5):
+        """
+        Purpose: To update the internal phase angle (theta) of each boid based
+        on its neighbors' phases, following the Kuramoto model of synchronization.
+        u is a neighbor array or its kuramotomatrix(). The mean of
+        sin(theta_j - theta_i) is Im(e^{-i theta_i} * mean_j e^{i theta_j}), so
+        one complex exponential per boid and one sparse mat-vec replace the
+        per-pair sines. The local order parameter r comes from the same
+        pass, the global one from the advanced phases.
+        """
+        if isinstance(u, tuple):
+            u = self.kuramotomatrix(u)
+        n = self.number
+        z = np.exp(1j * self.theta)
+        neighbor_mean = u @ z
+        self.local_r = np.abs(neighbor_mean)
+        self.omega[:n] += (np.conj(z[:n]) * neighbor_mean).imag * k
+        self.theta[:n] += self.omega[:n] * dt
+        if self.wrap_phases:
+            np.mod(self.theta, 2 * np.pi, out=self.theta)
+        self.order_r = float(order_parameter(self.theta[:n]))
+
+    def boundries2(self):
+        """Purpose: A simpler boundary check using the modulo operator."""
+        self.posv[:, 0] %= self.width
+        self.posv[:, 1] %= self.height
+        if self.dim == 3:
+            self.posv[:, 2] %= self.depth
+
+    def needsrebuild(self):
+        """
+        Purpose: Decides whether the cached neighbor lists must be rebuilt this
+        step: every recalc_interval frames, or with a skin set, as soon as two
+        boids could together have moved far enough to cross the skin and at
+        the latest recalc_interval frames after the last rebuild.
+        """
+        if self.voronoi_neighbors is None:
+            return True
+        if self.skin is None:
+            return self.frame_count % self.recalc_interval == 0
+        if self.frame_count - self.rebuild_frame >= self.recalc_interval:
+            return True
+        maxdisp = np.sqrt((self.displacement ** 2).sum(axis=1).max())
+        return 2 * maxdisp > self.skin
+
+    def buildneighbors(self):
+        """Purpose: Builds fresh (field-of-view filtered Voronoi, repulsion) neighbor arrays."""
+        voronoi_neighbors_raw, repel_neighbors = self.rawneighbors(self.bandmargin())
+        with self.stage('dotfilter1'):
+            voronoi_neighbors = self.dotfilter1(voronoi_neighbors_raw)
+        return voronoi_neighbors, repel_neighbors
+
+    def frame(self, out=None):
+        """
+        Purpose: The state recorded per frame, one [x, y, phase] row per boid
+        ([x, y, z, phase] in 3D), written into out when given.
+        """
+        if out is None:
+            out = np.empty((self.number, self.dim + 1), dtype=self.dtype)
+        out[:, :-1] = self.posv
+        out[:, -1] = self.theta
+        return out
+
+    def stage(self, name):
+        """
+        Purpose: Context manager timing one named stage of update1 on the
+        attached profiler; a shared no-op when profiler is None.
+        """
+        if self.profiler is None:
+            return NOSTAGE
+        return self.profiler.stage(name)
+
+    def rebuildneighbors(self):
+        """Purpose: Recomputes the cached Voronoi and repulsion neighbor lists."""
+        with self.stage('rebuild'):
+            self.voronoi_neighbors, self.repel_neighbors = self.buildneighbors()
+            with self.stage('kuramotomatrix'):
+                self.kuramoto_matrix = self.kuramotomatrix(self.voronoi_neighbors)
+        self.displacement.fill(0)
+        self.rebuild_frame = self.frame_count
+        self.rebuilds += 1
+        if self.profiler is not None:
+            self.profiler.rebuilt(self)
+
+    def substepsize(self, left):
+        """
+        Purpose: The next substep: the time left split into equal parts no
+        longer than substep_dv / max |acc| and substep_dphase / max |omega -
+        mean omega|. Only phase differences enter the coupling, so a common
+        rotation of every phase does not shorten the step.
+        """
+        hmax = left
+        amax = np.sqrt((self.acc ** 2).sum(axis=1).max())
+        if amax > 0:
+            hmax = min(hmax, self.substep_dv / amax)
+        wmax = np.abs(self.omega - self.omega.mean()).max()
+        if wmax > 0:
+            hmax = min(hmax, self.substep_dphase / wmax)
+        return left / np.ceil(left / hmax)
+
+    def substepframe(self, dt):
+        """
+        Purpose: The adaptive integrator behind update1. Covers dt with
+        explicit Euler substeps sized by substepsize, recomputing forces and
+        the Kuramoto coupling from the cached neighbor lists every substep.
+        With a skin the lists are refreshed between substeps as soon as
+        needsrebuild says so. The coupling is applied per nominal step of
+        length self.time, so a substep of h gets h / self.time of it.
+        """
+        left = dt
+        for i in range(self.max_substeps):
+            if i and self.skin is not None and self.needsrebuild():
+                self.rebuildneighbors()
+            w, q, b = self.flockforces(self.repel_neighbors, self.voronoi_neighbors)
+
+            with self.stage('integrate'):
+                self.acc += self.alignp * q + self.cenp * b + self.repp * w
+                clamp_rows(self.acc, self.maxacc)
+                h = left if i == self.max_substeps - 1 else self.substepsize(left)
+
+                self.velv += self.acc * h
+                clamp_rows(self.velv, self.maxvel)
+
+                self.posv += self.velv * h
+                self.displacement += self.velv * h
+                self.boundries2()
+
+            with self.stage('kthetaupdate111'):
+                # 0.5 is kthetaupdate111's default coupling per step
+                self.kthetaupdate111(h, self.kuramoto_matrix, k=0.5 * h / self.time)
+
+            self.acc.fill(0)
+            self.substeps += 1
+            left -= h
+            if left <= 1e-12 * dt:
+                break
+
+    def update1(self, dt=.05):
+        """
+        Purpose: To run one full step of the simulation, orchestrating all
+        the physics and behavior calculations. This is the main update loop.
+        With adaptive set the step is split into substeps (see substepframe).
+        """
+        self.frame_count += 1
+        if self.profiler is not None:
+            self.profiler.begin(self.frame_count)
+        if self.needsrebuild():
+            self.rebuildneighbors()
+        else:
+            self.rebuilds_skipped += 1
+
+        if self.adaptive:
+            self.substepframe(dt)
+        else:
+            w, q, b = self.flockforces(self.repel_neighbors, self.voronoi_neighbors)
+
+            with self.stage('integrate'):
+                self.acc += self.alignp * q + self.cenp * b + self.repp * w
+
+                clamp_rows(self.acc, self.maxacc)
+
+                self.velv += self.acc * dt
+                clamp_rows(self.velv, self.maxvel)
+
+                self.posv += self.velv * dt
+                self.displacement += self.velv * dt
+                self.boundries2()
+
+            with self.stage('kthetaupdate111'):
+                self.kthetaupdate111(dt, self.kuramoto_matrix)
+
+            self.acc.fill(0)
+        self.boidsx = self.posv[:, 0]
+        self.boidsy = self.posv[:, 1]
+        if self.order_history is not None:
+            self.order_history.append(self.order_r)
+        if self.metrics is not None:
+            with self.stage('metrics'):
+                self.metrics.sample()
+        if self.profiler is not None:
+            self.profiler.end(self)
+
+
+def mergecsr(parts, n):
+    """Stacks per-flock neighbor arrays of n boids each into one block-diagonal neighbor array."""
+    offsets = [np.zeros(1, dtype=np.int64)]
+    base = 0
+    for m, (off, indices, images) in enumerate(parts):
+        offsets.append(off[1:].astype(np.int64) + base)
+        base += off[-1]
+    indices = np.concatenate([p[1].astype(np.int64) + m * n for m, p in enumerate(parts)])
+    images = np.concatenate([p[2] for p in parts])
+    return np.concatenate(offsets), indices, images
+
+
+class boidensemble(boidflock):
+    """
+    Runs M independent flocks of N boids as one (M, N, 2) position/velocity
+    array and (M, N) phases. Every replica keeps its own neighbor structure
+    (built by a per-replica boidflock viewing its slice of the arrays) and
+    its own parameters, but steering, clamping and the Kuramoto step run
+    once over all M * N boids, with neighbor indices offset per replica so
+    no two flocks ever interact.
+    """
+    def __init__(self, c, v, kus, ooo, params=None, dt=.05, skin=None, dtype=np.float64):
+        M, N = kus.shape
+        if params is None or isinstance(params, dict):
+            params = [dict(params or {})] * M
+        super().__init__(c.reshape(M * N, 2), v.reshape(M * N, 2),
+                         kus.reshape(M * N), ooo.reshape(M * N), n=M * N, dt=dt, skin=skin,
+                         dtype=dtype)
+        self.replicas_count = M
+        self.flocksize = N
+        self.pos = self.posv.reshape(M, N, 2)
+        self.vel = self.velv.reshape(M, N, 2)
+        self.phases = self.theta.reshape(M, N)
+
+        # One boidflock per replica that shares its slice of the arrays; it is
+        # only used to build that replica's neighbor lists.
+        self.replicas = []
+        for m in range(M):
+            r = boidflock(c[m], v[m], kus[m], ooo[m], n=N, dt=dt, skin=skin, dtype=dtype, **params[m])
+            r.posv = self.pos[m]
+            r.velv = self.vel[m]
+            self.replicas.append(r)
+
+        # Per-boid copies of the per-replica parameters
+        per = lambda name: np.repeat([getattr(r, name) for r in self.replicas], N).astype(self.dtype)
+        self.alignp = per('alignp')[:, None]
+        self.cenp = per('cenp')[:, None]
+        self.repp = per('repp')[:, None]
+        self.maxvel = per('maxvel')
+        self.maxacc = per('maxacc')
+        self.width = per('width')
+        self.height = per('height')
+        # Topological replicas never cut repulsion by distance
+        self.rr = np.repeat([np.inf if r.topok is not None else r.rr for r in self.replicas], N)
+        self.topok = None
+        self.shifttable = np.stack([r.shifts() for r in self.replicas])
+        self.box = np.array([[r.width, r.height] for r in self.replicas], dtype=self.dtype)
+
+    def neighborpos(self, indices, images, rows=None):
+        """Purpose: Same as boidflock.neighborpos, with each replica's own box."""
+        replica = indices // self.flocksize
+        if self.skin is None or rows is None:
+            return self.posv[indices] + self.shifttable[replica, images]
+        d = self.posv[indices] - self.posv[rows]
+        box = self.box[replica]
+        return self.posv[rows] + d - box * np.round(d / box)
+
+    def buildneighbors(self):
+        """Purpose: Builds every replica's neighbor lists and stacks them block-diagonally."""
+        built = [r.buildneighbors() for r in self.replicas]
+        return (mergecsr([b[0] for b in built], self.flocksize),
+                mergecsr([b[1] for b in built], self.flocksize))
+
+    def replica_order(self):
+        """Purpose: Kuramoto order parameter r of each replica."""
+        return np.abs(np.exp(1j * self.phases).mean(axis=1))
+
+
+
+# --- DOMAIN DECOMPOSITION ---
+
+# boidflock attributes a domainflock hands its workers on top of the constructor arguments
+DOMAIN_SETTINGS = ('maxvel', 'maxacc', 'recalc_interval', 'certify_band')
+
+class domainstrip(boidflock):
+    """
+    One vertical strip of a domainflock's periodic box, as stepped by one
+    worker process. Its rows are the boids it owns followed by read-only
+    halo rows: copies, at the periodic image they are seen through, of every
+    boid an owned boid takes as a Voronoi or repulsion neighbor. Ownership
+    and halo are rebuilt with the neighbor lists; in between only the halo
+    rows' state is re-read from the shared arrays.
+    """
+    def __init__(self, k, strips, **params):
+        empty = np.zeros((0, 2))
+        super().__init__(empty, empty, np.zeros(0), np.zeros(0), n=0, **params)
+        self.strip = k
+        self.strips = strips
+        self.x0 = self.width * k / strips
+        self.x1 = self.width * (k + 1) / strips
+        self.total = 0          # Boids in the whole box
+        self.source = None      # (pos, vel, theta, omega) shared arrays of the current step
+        self.owned = None       # Global index of every owned boid
+        self.localreal = None   # Global index of every row, owned then halo
+        self.localshift = None  # Periodic shift every row is seen through
+
+    def owner(self, positions):
+        """Purpose: The strip each position lies in."""
+        return np.minimum((positions[:, 0] * self.strips / self.width).astype(np.intp), self.strips - 1)
+
+    def bandmargin(self):
+        """
+        Purpose: boidflock.bandmargin sized for the whole box, and never
+        narrower than rr so the halo holds every repulsion neighbor.
+        """
+        if self.margin is not None:
+            return max(self.margin, self.rr)
+        return max(2.0 * np.sqrt(self.width * self.height / self.total), self.rr)
+
+    def bandregion(self, margin):
+        """Purpose: The strip widened by margin on every side."""
+        return (np.array([self.x0 - margin, -margin]),
+                np.array([self.x1 + margin, self.height + margin]))
+
+    def regionpoints(self, positions, margin):
+        """
+        Purpose: Every periodic image of every boid inside bandregion(margin),
+        owned boids first. Returns the points plus the global boid and pen()
+        image code of each, like penband.
+        """
+        sh = self.shifts()
+        (xlo, ylo), (xhi, yhi) = self.bandregion(margin)
+        others = np.ones(len(positions), dtype=bool)
+        others[self.owned] = False
+        reals, images = [self.owned], [np.zeros(self.owned.size, dtype=np.int64)]
+        for code in range(9):
+            x = positions[:, 0] + sh[code, 0]
+            y = positions[:, 1] + sh[code, 1]
+            inside = (x >= xlo) & (x <= xhi) & (y >= ylo) & (y <= yhi)
+            if code == 0:
+                inside &= others
+            idx = np.flatnonzero(inside)
+            reals.append(idx)
+            images.append(np.full(idx.size, code))
+        real = np.concatenate(reals)
+        image = np.concatenate(images)
+        return positions[real] + sh[image], real, image
+
+    def regionpairs(self, points):
+        """
+        Purpose: Repulsion neighbors of the owned boids, everything within rr,
+        as indices into the region points. The region already holds the
+        periodic images, so a plain KD-tree does.
+        """
+        n = self.number
+        pairs = scipy.spatial.cKDTree(points).query_pairs(self.rr, output_type='ndarray')
+        rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+        mine = rows < n
+        rows, cols = rows[mine], cols[mine]
+        order = np.argsort(rows, kind='stable')
+        offsets = np.zeros(n + 1, dtype=np.int32)
+        np.cumsum(np.bincount(rows, minlength=n), out=offsets[1:])
+        return offsets, cols[order].astype(np.int32), np.zeros(cols.size, dtype=np.int8)
+
+    def rawneighbors(self, margin):
+        """
+        Purpose: Takes ownership of the boids now in the strip, then builds
+        their Voronoi and repulsion neighbors from the region around it,
+        widening the region while certify_band is on and some owned cell
+        could still differ from the full periodic tiling. The neighbors
+        picked become the halo rows.
+        """
+        positions = self.source[0]
+        self.owned = np.flatnonzero(self.owner(positions) == self.strip)
+        self.number = n = self.owned.size
+        full = max(self.width, self.height)
+        while True:
+            with self.stage('penband'):
+                points, real, image = self.regionpoints(positions, margin)
+            if n == 0:
+                break
+            with self.stage('voronoi'):
+                g = Voronoi(points)
+            if margin >= full or not self.certify_band:
+                break
+            with self.stage('bandcertified'):
+                certified = self.bandcertified(g, margin)
+            if certified:
+                break
+            margin = min(2 * margin, full)
+        self.band_margin = margin
+        self.band_points = len(points)
+        if n == 0:
+            voronoi = (np.zeros(1, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int8))
+        else:
+            with self.stage('neigh1'):
+                voronoi = self.neigh1(g, np.arange(len(points)), np.zeros(len(points), dtype=np.int8))
+        with self.stage('kdtree_query'):
+            repel = self.regionpairs(points)
+
+        # Owned boids keep rows 0..n-1, every region point still in use gets a halo row
+        used = np.concatenate([voronoi[1], repel[1]])
+        halo = np.unique(used[used >= n])
+        local = np.zeros(len(points), dtype=np.int32)
+        local[:n] = np.arange(n)
+        local[halo] = n + np.arange(halo.size)
+        rows = np.concatenate([np.arange(n), halo])
+        self.localreal = real[rows]
+        self.localshift = self.shifts()[image[rows]]
+        self.gather()
+        return ((voronoi[0], local[voronoi[1]], voronoi[2]),
+                (repel[0], local[repel[1]], repel[2]))
+
+    def gather(self):
+        """Purpose: Reads the owned and halo rows' state from the shared arrays."""
+        pos, vel, theta, omega = self.source
+        self.posv = pos[self.localreal] + self.localshift
+        self.velv = vel[self.localreal]
+        self.theta = theta[self.localreal]
+        self.omega = omega[self.localreal]
+
+    def step(self, source, target, frame, dt):
+        """
+        Purpose: boidflock.update1 for the owned boids. Reads the state from
+        the source (pos, vel, theta, omega) arrays, rebuilding ownership,
+        halo and neighbor lists when due, and writes the owned boids' next
+        state into the target arrays.
+        """
+        self.source = source
+        self.total = len(source[0])
+        self.frame_count = frame
+        if self.needsrebuild():
+            self.rebuildneighbors()
+        else:
+            self.gather()
+            self.rebuilds_skipped += 1
+        n = self.number
+        if n == 0:
+            return  # Nothing in the strip to steer until the next rebuild
+        w, q, b = self.flockforces(self.repel_neighbors, self.voronoi_neighbors)
+
+        with self.stage('integrate'):
+            acc = self.alignp * q + self.cenp * b + self.repp * w
+            clamp_rows(acc, self.maxacc)
+
+            vel = self.velv[:n]
+            vel += acc * dt
+            clamp_rows(vel, self.maxvel)
+
+            pos = self.posv[:n]
+            pos += vel * dt
+            pos[:, 0] %= self.width
+            pos[:, 1] %= self.height
+
+        with self.stage('kthetaupdate111'):
+            self.kthetaupdate111(dt, self.kuramoto_matrix)
+
+        for array, rows in zip(target, (pos, vel, self.theta[:n], self.omega[:n])):
+            array[self.owned] = rows
+
+
+def domainarrays(buf, number):
+    """The two (pos, vel, theta, omega) state buffers of a domainflock, laid over one shared block."""
+    pos = np.ndarray((2, number, 2), dtype=np.float64, buffer=buf)
+    vel = np.ndarray((2, number, 2), dtype=np.float64, buffer=buf, offset=32 * number)
+    theta = np.ndarray((2, number), dtype=np.float64, buffer=buf, offset=64 * number)
+    omega = np.ndarray((2, number), dtype=np.float64, buffer=buf, offset=80 * number)
+    return [(pos[i], vel[i], theta[i], omega[i]) for i in range(2)]
+
+def domainworker(k, strips, name, number, params, settings, control, barrier):
+    """
+    Body of a domainflock worker process: steps strip k every time the
+    parent passes the barrier, until control says stop. An error breaks the
+    barrier so the parent does not wait forever.
+    """
+    memory = shared_memory.SharedMemory(name=name)
+    buffers = strip = None
+    try:
+        buffers = domainarrays(memory.buf, number)
+        strip = domainstrip(k, strips, **params)
+        for key, value in settings.items():
+            setattr(strip, key, value)
+        while True:
+            barrier.wait()
+            command, frame, dt = control[:]
+            if command == 0:
+                break
+            frame = int(frame)
+            strip.step(buffers[frame % 2], buffers[1 - frame % 2], frame, dt)
+            barrier.wait()
+    except threading.BrokenBarrierError:
+        pass  # Another worker failed and the parent is shutting down
+    except BaseException:
+        barrier.abort()
+        raise
+    finally:
+        buffers = strip = None
+        memory.close()
+
+class domainflock:
+    """
+    Runs a 2D boidflock split into vertical strips of its periodic box, one
+    worker process per strip. The state lives in shared memory, double
+    buffered so every worker reads step t while writing step t + 1. A worker
+    owns the boids inside its strip and sees the others only through a halo
+    of the boids within interaction range (see domainstrip); boids migrate
+    between strips at every neighbor rebuild. Neighbor sets and update
+    rules are the single-process ones, so trajectories agree with
+    boidflock.update1 up to rounding (neighbor sums run in another order).
+
+    Picks up from flockobject's current state, and has the parts of the
+    boidflock interface that create_frame, stream_frames and run_pipeline
+    use; posv, velv, theta and omega are views of the shared state, valid
+    until close(). Workers are forked where the platform allows it, as in
+    run_sweep.
+    """
+    def __init__(self, flockobject, workers=None):
+        f = flockobject
+        if (isinstance(f, boidensemble) or f.dim != 2 or f.dtype != np.float64 or f.skin is not None
+                or f.topok is not None or f.nearest is not None or f.adaptive):
+            raise ValueError("domainflock runs 2D float64 boidflocks without skin, topok, nearest or adaptive")
+        self.workers = workers or os.cpu_count() or 1
+        self.number = f.number
+        self.width = f.width
+        self.height = f.height
+        self.dim = 2
+        self.depth = None
+        self.dtype = f.dtype
+        self.time = f.time
+        self.alignp, self.cenp, self.repp = f.alignp, f.cenp, f.repp
+        self.angle = f.angle
+        self.rr = f.rr
+        self.frame_count = f.frame_count
+        self.order_r = f.order_r
+        self.order_history = None if f.order_history is None else list(f.order_history)
+
+        self.memory = shared_memory.SharedMemory(create=True, size=96 * self.number)
+        self.buffers = domainarrays(self.memory.buf, self.number)
+        for array, value in zip(self.buffers[self.parity], (f.posv, f.velv, f.theta, f.omega)):
+            array[...] = value
+
+        params = dict(w=f.width, h=f.height, dt=f.time, rradiusrep=f.rr, angle=f.angle,
+                      alignp=f.alignp, cenp=f.cenp, repp=f.repp, margin=f.margin)
+        settings = {name: getattr(f, name) for name in DOMAIN_SETTINGS}
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else multiprocessing
+        self.control = context.Array('d', [1, self.frame_count, self.time], lock=False)
+        self.barrier = context.Barrier(self.workers + 1)
+        self.processes = [context.Process(target=domainworker, daemon=True,
+                                          args=(k, self.workers, self.memory.name, self.number,
+                                                params, settings, self.control, self.barrier))
+                          for k in range(self.workers)]
+        for process in self.processes:
+            process.start()
+
+    @property
+    def parity(self):
+        """Purpose: Which of the two buffers holds the current state."""
+        return (self.frame_count + 1) % 2
+
+    @property
+    def posv(self):
+        return self.buffers[self.parity][0]
+
+    @property
+    def velv(self):
+        return self.buffers[self.parity][1]
+
+    @property
+    def theta(self):
+        return self.buffers[self.parity][2]
+
+    @property
+    def omega(self):
+        return self.buffers[self.parity][3]
+
+    def update1(self, dt=.05):
+        """Purpose: One boidflock.update1 step, every strip in parallel."""
+        self.frame_count += 1
+        self.control[:] = [1, self.frame_count, dt]
+        try:
+            self.barrier.wait()  # Workers start the step
+            self.barrier.wait()  # and have all written it
+        except threading.BrokenBarrierError:
+            raise RuntimeError("a domainflock worker failed") from None
+        self.order_r = float(order_parameter(self.theta))
+        if self.order_history is not None:
+            self.order_history.append(self.order_r)
+
+    def frame(self, out=None):
+        """Purpose: Same as boidflock.frame."""
+        if out is None:
+            out = np.empty((self.number, 3), dtype=self.dtype)
+        out[:, :-1] = self.posv
+        out[:, -1] = self.theta
+        return out
+
+    def close(self):
+        """Purpose: Stops the workers and frees the shared memory."""
+        if self.memory is None:
+            return
+        self.control[0] = 0
+        try:
+            self.barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+        for process in self.processes:
+            process.join()
+        self.buffers = None
+        self.memory.close()
+        self.memory.unlink()
+        self.memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# --- DATA GENERATION AND ANALYSIS ---
+
+def calculate_entropy(positions, width, height, grid_size=30):
+    """Calculates the positional Shannon entropy of the flock."""
+    # Create a 2D histogram (count boids in each grid cell)
+    counts, _, _ = np.histogram2d(
+        positions[:, 0], positions[:, 1],
+        bins=grid_size, range=[[0, width], [0, height]]
+    )
+    # Calculate the probability distribution
+    total_boids = np.sum(counts)
+    if total_boids == 0:
+        return 0 # Return 0 if there are no boids
+        
+    probabilities = counts / total_boids
+    # Filter out zero probabilities to avoid log(0) errors
+    probabilities = probabilities[probabilities > 0]
+    # Calculate Shannon Entropy
+    entropy = -np.sum(probabilities * np.log2(probabilities))
+    return entropy
+
+def polarization(velocities):
+    """Length of the mean heading: 1 when every boid flies the same way, ~0 when disordered."""
+    speeds = np.linalg.norm(velocities, axis=1)
+    moving = speeds > 0
+    if not moving.any():
+        return 0.0
+    return np.linalg.norm((velocities[moving] / speeds[moving, None]).mean(axis=0))
+
+def order_parameter(theta):
+    """Global Kuramoto order parameter r = |<e^{i theta}>|."""
+    return np.abs(np.exp(1j * theta).mean())
+
+class occupancygrid:
+    """
+    Keeps the grid_size x grid_size occupancy counts of calculate_entropy up
+    to date incrementally: each update only touches the cells boids entered
+    or left, and the entropy comes from a running sum of c * log2(c), since
+    H = log2(N) - sum(c log2 c) / N.
+    """
+    def __init__(self, width, height, grid_size=30):
+        self.width = width
+        self.height = height
+        self.grid_size = grid_size
+        self.counts = np.zeros(grid_size * grid_size, dtype=np.int64)
+        self.cells = None
+        self.clogc = 0.0
+
+    def cellof(self, positions):
+        g = self.grid_size
+        ix = np.minimum((positions[:, 0] / self.width * g).astype(np.int64), g - 1)
+        iy = np.minimum((positions[:, 1] / self.height * g).astype(np.int64), g - 1)
+        return ix * g + iy
+
+    def update(self, positions):
+        cells = self.cellof(positions)
+        if self.cells is None or len(cells) != len(self.cells):
+            self.counts[:] = np.bincount(cells, minlength=self.counts.size)
+            c = self.counts[self.counts > 0]
+            self.clogc = float((c * np.log2(c)).sum())
+            self.cells = cells
+            return
+        moved = cells != self.cells
+        if not moved.any():
+            return
+        touched = np.unique(np.concatenate([self.cells[moved], cells[moved]]))
+        before = self.counts[touched]
+        np.subtract.at(self.counts, self.cells[moved], 1)
+        np.add.at(self.counts, cells[moved], 1)
+        after = self.counts[touched]
+        xlogx = lambda c: c * np.log2(np.maximum(c, 1))
+        self.clogc += float((xlogx(after) - xlogx(before)).sum())
+        self.cells = cells
+
+    def entropy(self):
+        n = 0 if self.cells is None else len(self.cells)
+        if n == 0:
+            return 0
+        return np.log2(n) - self.clogc / n
+
+
+class flockmetrics:
+    """
+    On-the-fly observables for a boidflock. Attaching it (flockmetrics(flock))
+    makes update1 call sample() after every step; each observable is only
+    evaluated every `every[name]` frames and stored with its frame number in
+    a preallocated, doubling time-series buffer. Built in: entropy
+    (incremental occupancy grid), polarization, order_r, neighbors (mean
+    filtered Voronoi neighbor count) and nn_distance (mean nearest-neighbor
+    distance). register() adds more; an interval of 0 or None turns one off.
+    """
+    def __init__(self, flockobject, every=None, grid_size=30):
+        self.flock = flockobject
+        self.occupancy = occupancygrid(flockobject.width, flockobject.height, grid_size)
+        self.observables = {}
+        self.buffers = {}
+        defaults = {
+            'entropy': (self.entropy, 1),
+            'polarization': (lambda f: polarization(f.velv), 1),
+            'order_r': (lambda f: f.order_r, 1),
+            'neighbors': (lambda f: np.diff(f.voronoi_neighbors[0]).mean(), 1),
+            'nn_distance': (self.nn_distance, 10),
+        }
+        every = every or {}
+        for name, (fn, interval) in defaults.items():
+            self.register(name, fn, every.get(name, interval))
+        flockobject.metrics = self
+
+    def register(self, name, fn, every=1, capacity=256):
+        """Adds an observable fn(flock) -> float sampled every `every` frames."""
+        if not every:
+            return
+        self.observables[name] = (fn, every)
+        self.buffers[name] = [np.empty(capacity, dtype=np.int32), np.empty(capacity), 0]
+
+    def entropy(self, flockobject):
+        self.occupancy.update(flockobject.posv)
+        return self.occupancy.entropy()
+
+    def nn_distance(self, flockobject):
+        distances, _ = flockobject.periodictree().query(flockobject.posv, k=2)
+        return distances[:, 1].mean()
+
+    def sample(self):
+        frame = self.flock.frame_count
+        for name, (fn, every) in self.observables.items():
+            if frame % every:
+                continue
+            buf = self.buffers[name]
+            frames, values, n = buf
+            if n == len(frames):
+                buf[0] = frames = np.resize(frames, 2 * n)
+                buf[1] = values = np.resize(values, 2 * n)
+            frames[n] = frame
+            values[n] = fn(self.flock)
+            buf[2] = n + 1
+
+    def series(self, name):
+        """(frame numbers, values) recorded so far for one observable."""
+        frames, values, n = self.buffers[name]
+        return frames[:n], values[:n]
+
+
+def create_frame(flockobject, n_frames, steady=None):
+    """
+    Runs the simulation and stores the state and entropy of each frame.
+    With a steadystate given the run stops at the first frame it reports
+    settled, and only the frames up to it are returned.
+    """
+    print("Running simulation to generate all frame data...")
+    # Array to hold [x, y, phase] (or [x, y, z, phase]) for each boid at each frame
+    frame_data = np.zeros((n_frames, flockobject.number, flockobject.dim + 1), dtype=flockobject.dtype)
+    # Array to hold the entropy value for each frame
+    entropy_history = np.zeros(n_frames)
+    occupancy = occupancygrid(flockobject.width, flockobject.height)
+
+    for i in range(n_frames):
+        flockobject.update1(flockobject.time)
+        flockobject.frame(frame_data[i])
+        # Update the occupancy grid and store the entropy for the current frame
+        occupancy.update(flockobject.posv)
+        entropy_history[i] = occupancy.entropy()
+        if steady is not None and steady.update(steadyvalues(flockobject, entropy_history[i])):
+            print(f"Steady state reached after {i + 1} of {n_frames} frames.")
+            return frame_data[:i + 1], entropy_history[:i + 1]
+
+    print("Simulation complete.")
+    return frame_data, entropy_history
+
+def stream_frames(flockobject, n_frames):
+    """
+    Runs the simulation lazily, yielding each frame's [x, y, phase] array
+    as soon as it is simulated, so nothing grows with the number of frames.
+    """
+    for i in range(n_frames):
+        flockobject.update1(flockobject.time)
+        yield flockobject.frame()
+
+class trajectorywriter:
+    """
+    Writes frames one at a time into a memory-mapped .npy file of shape
+    (n_frames, N, 3) (4 columns in 3D), flushing every `chunk` frames. A small JSON header
+    next to it (path + '.json') records the box, time step, parameters
+    and how many frames have been written so far, so an interrupted run
+    is still readable. close() returns the trajectory via open_trajectory.
+    """
+    def __init__(self, path, n_frames, flockobject, chunk=64):
+        self.path = path
+        self.chunk = chunk
+        self.written = 0
+        self.trajectory = np.lib.format.open_memmap(
+            path, mode='w+', dtype=flockobject.dtype,
+            shape=(n_frames, flockobject.number, flockobject.dim + 1))
+        self.meta = {
+            'number': flockobject.number,
+            'width': flockobject.width,
+            'height': flockobject.height,
+            'depth': flockobject.depth,
+            'dt': flockobject.time,
+            'columns': ['x', 'y', 'z'][:flockobject.dim] + ['theta'],
+            'dtype': flockobject.dtype.name,
+            'params': {'alignp': flockobject.alignp, 'cenp': flockobject.cenp,
+                       'repp': flockobject.repp, 'angle': flockobject.angle,
+                       'rradiusrep': flockobject.rr},
+            'frames': n_frames,
+            'frames_written': 0,
+        }
+
+    def write(self, frame):
+        self.trajectory[self.written] = frame
+        self.written += 1
+        if self.written % self.chunk == 0:
+            self.flush()
+
+    def flush(self):
+        self.trajectory.flush()
+        self.meta['frames_written'] = self.written
+        with open(self.path + '.json', 'w') as f:
+            json.dump(self.meta, f, indent=1)
+
+    def close(self):
+        self.flush()
+        self.trajectory = None
+        return open_trajectory(self.path)
+
+def write_trajectory(path, frames, n_frames, flockobject, chunk=64):
+    """
+    Writes streamed frames with a trajectorywriter and returns the
+    trajectory via open_trajectory.
+    """
+    writer = trajectorywriter(path, n_frames, flockobject, chunk)
+    for frame in itertools.islice(frames, n_frames):
+        writer.write(frame)
+    return writer.close()
+
+def open_trajectory(path):
+    """
+    Opens a trajectory written by write_trajectory as a read-only memory map
+    (only the frames that were actually written) plus its metadata. Slicing
+    it only reads the frames that are touched.
+    """
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    data = np.load(path, mmap_mode='r')
+    return data[:meta['frames_written']], meta
+
+def entropy_series(frames, width, height, grid_size=30):
+    """Positional entropy of every frame of a (possibly memory-mapped) trajectory, one frame at a time."""
+    return np.array([calculate_entropy(frame[:, 0:2], width, height, grid_size) for frame in frames])
+
+def map_phase_to_size(phases, min_size=20, max_size=250):
+    """Maps a phase angle to a pulsing size for a 'blink' effect."""
+    normalized_pulse = (np.sin(phases) + 1) / 2
+    return min_size + normalized_pulse * (max_size - min_size)
+
+# --- PROFILING ---
+
+class stageprofiler:
+    """
+    Per-stage timer for boidflock.update1. Attaching it
+    (stageprofiler(flock)) makes every instrumented stage (ghost band,
+    Voronoi, neigh1, dotfilter1, KD-tree build and query, the three force
+    kernels, integration and clamping, the Kuramoto update) record a
+    (stage, frame, start, duration) span, and every frame its neighbor list
+    sizes and whether the lists were rebuilt. With no profiler attached each
+    stage costs one `is None` test. summary() prints a table of where the
+    time goes, sharing out each frame by self time (a stage's time minus
+    the stages nested in it, e.g. rebuild minus voronoi); write_trace() saves Chrome trace-event JSON for
+    chrome://tracing or Perfetto.
+    """
+    def __init__(self, flockobject=None):
+        self.spans = []     # (stage, frame, start ns, duration ns)
+        self.self_ns = {}   # stage -> total ns not spent in a nested stage
+        self.open = []      # ns spent in nested stages, one entry per stage now running
+        self.frames = []    # (frame, start ns, duration ns, voronoi pairs, repel pairs, rebuilt)
+        self.rebuild_log = []  # (frame, time ns, band margin, band points)
+        self.frame = -1
+        self.frame_start = 0
+        self.rebuilt_now = False
+        self.origin = time.perf_counter_ns()
+        if flockobject is not None:
+            flockobject.profiler = self
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter_ns()
+        self.open.append(0)
+        try:
+            yield
+        finally:
+            duration = time.perf_counter_ns() - start
+            nested = self.open.pop()
+            if self.open:
+                self.open[-1] += duration
+            self.self_ns[name] = self.self_ns.get(name, 0) + duration - nested
+            self.spans.append((name, self.frame, start, duration))
+
+    def begin(self, frame):
+        self.frame = frame
+        self.rebuilt_now = False
+        self.frame_start = time.perf_counter_ns()
+
+    def rebuilt(self, flockobject):
+        self.rebuilt_now = True
+        self.rebuild_log.append((self.frame, time.perf_counter_ns(),
+                                 flockobject.band_margin, flockobject.band_points))
+
+    def end(self, flockobject):
+        self.frames.append((self.frame, self.frame_start,
+                            time.perf_counter_ns() - self.frame_start,
+                            len(flockobject.voronoi_neighbors[1]),
+                            len(flockobject.repel_neighbors[1]), self.rebuilt_now))
+
+    def totals(self):
+        """{stage: (calls, total seconds)}, in order of first appearance."""
+        out = {}
+        for name, _, _, duration in self.spans:
+            calls, total = out.get(name, (0, 0))
+            out[name] = (calls + 1, total + duration)
+        return {name: (calls, total / 1e9) for name, (calls, total) in out.items()}
+
+    def summary(self):
+        """
+        Returns (and prints) a table of per-stage call counts and times.
+        total ms includes nested stages, self ms and % step do not, so the
+        % step column adds up to the instrumented share of update1.
+        """
+        frames = max(len(self.frames), 1)
+        step = sum(f[2] for f in self.frames) / 1e9
+        lines = [f"{'stage':<16}{'calls':>8}{'total ms':>11}{'self ms':>10}{'ms/frame':>10}{'% step':>8}"]
+        for name, (calls, total) in self.totals().items():
+            own = self.self_ns[name] / 1e9
+            share = 100 * own / step if step else 0
+            lines.append(f"{name:<16}{calls:>8d}{1e3 * total:>11.2f}{1e3 * own:>10.2f}"
+                         f"{1e3 * total / frames:>10.3f}{share:>8.1f}")
+        lines.append(f"{'update1':<16}{len(self.frames):>8d}{1e3 * step:>11.2f}{'':>10}"
+                     f"{1e3 * step / frames:>10.3f}{100.0 if step else 0:>8.1f}")
+        if self.frames:
+            sizes = np.array([f[3:5] for f in self.frames], dtype=float)
+            lines.append(f"{len(self.rebuild_log)} rebuilds in {len(self.frames)} frames, "
+                         f"mean neighbor pairs: voronoi {sizes[:, 0].mean():.0f}, repel {sizes[:, 1].mean():.0f}")
+        text = "\n".join(lines)
+        print(text)
+        return text
+
+    def trace_events(self):
+        """The recorded spans and counters as Chrome trace-event dicts (microseconds)."""
+        us = lambda ns: (ns - self.origin) / 1e3
+        events = []
+        for frame, start, duration, voronoi, repel, rebuilt in self.frames:
+            events.append({'name': 'update1', 'cat': 'frame', 'ph': 'X', 'pid': 0, 'tid': 0,
+                           'ts': us(start), 'dur': duration / 1e3,
+                           'args': {'frame': frame, 'rebuilt': rebuilt}})
+            events.append({'name': 'neighbor pairs', 'ph': 'C', 'pid': 0, 'tid': 0,
+                           'ts': us(start), 'args': {'voronoi': voronoi, 'repel': repel}})
+        for name, frame, start, duration in self.spans:
+            events.append({'name': name, 'cat': 'stage', 'ph': 'X', 'pid': 0, 'tid': 0,
+                           'ts': us(start), 'dur': duration / 1e3, 'args': {'frame': frame}})
+        for frame, when, margin, points in self.rebuild_log:
+            events.append({'name': 'rebuild', 'cat': 'neighbors', 'ph': 'i', 's': 't',
+                           'pid': 0, 'tid': 0, 'ts': us(when),
+                           'args': {'frame': frame, 'band_margin': margin, 'band_points': points}})
+        return events
+
+    def write_trace(self, path):
+        """Saves the trace as JSON loadable by chrome://tracing or ui.perfetto.dev."""
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, f)
+
+
+# --- SEEDING AND CHECKPOINTS ---
+
+def seeded_flock(nb, seed, dim=2, **params):
+    """
+    Builds a boidflock whose initial conditions (same recipe as the notebook
+    setup) come from np.random.default_rng(seed) instead of the global
+    random state, so a run is fully determined by (nb, seed, params). The
+    Generator is kept on flock.rng. dim=3 fills a w x h x depth box.
+    """
+    rng = np.random.default_rng(seed)
+    w, h = params.get('w', 300), params.get('h', 300)
+    box = [w, h] if dim == 2 else [w, h, params.get('depth') or w]
+    a = np.array(box) * rng.random((nb, dim))
+    wqwq = 50 * rng.uniform(low=-1, high=1, size=(nb, dim))
+    kus = 2 * np.pi * rng.random(nb)
+    omeg = np.ones(nb)
+    flock = boidflock(a, wqwq, kus, omeg, n=nb, **params)
+    flock.rng = rng
+    return flock
+
+CHECKPOINT_PARAMS = ['number', 'width', 'height', 'depth', 'time', 'maxvel', 'maxacc', 'alignp',
+                     'cenp', 'repp', 'angle', 'rr', 'topok', 'nearest', 'margin', 'skin',
+                     'certify_band', 'recalc_interval', 'adaptive', 'substep_dv', 'substep_dphase',
+                     'max_substeps', 'substeps', 'frame_count', 'rebuild_frame', 'rebuilds',
+                     'rebuilds_skipped', 'band_margin', 'band_points', 'order_r']
+CHECKPOINT_ARRAYS = ['posv', 'velv', 'acc', 'theta', 'omega', 'displacement', 'local_r']
+
+def save_checkpoint(flockobject, path):
+    """
+    Saves everything needed to continue a boidflock run bit for bit: state
+    arrays, parameters, counters, the cached neighbor arrays and the
+    Generator state, as one .npz. It is written to a temporary file first
+    and then renamed, so a run killed mid-save keeps its last checkpoint.
+    An attached flockmetrics is not saved.
+    """
+    arrays = {name: getattr(flockobject, name) for name in CHECKPOINT_ARRAYS}
+    for cache in ('voronoi_neighbors', 'repel_neighbors'):
+        if getattr(flockobject, cache) is not None:
+            for part, a in zip(('offsets', 'indices', 'images'), getattr(flockobject, cache)):
+                arrays[f'{cache}_{part}'] = a
+    if flockobject.order_history is not None:
+        arrays['order_history'] = np.array(flockobject.order_history, dtype=np.float64)
+    meta = {name: getattr(flockobject, name) for name in CHECKPOINT_PARAMS}
+    meta['rng'] = None if flockobject.rng is None else flockobject.rng.bit_generator.state
+    arrays['meta'] = np.array(json.dumps(meta))
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+def load_checkpoint(path):
+    """Rebuilds the boidflock saved by save_checkpoint, ready to continue with update1."""
+    with np.load(path) as data:
+        meta = json.loads(str(data['meta']))
+        flock = boidflock(data['posv'], data['velv'], data['theta'], data['omega'],
+                          n=meta['number'], w=meta['width'], h=meta['height'], dt=meta['time'],
+                          rradiusrep=meta['rr'], angle=meta['angle'], alignp=meta['alignp'],
+                          cenp=meta['cenp'], repp=meta['repp'], margin=meta['margin'],
+                          skin=meta['skin'], topok=meta['topok'], dtype=data['posv'].dtype,
+                          depth=meta.get('depth'), nearest=meta.get('nearest'))
+        for name in CHECKPOINT_PARAMS:
+            if name in meta:  # older checkpoints lack the 3D and substepping settings
+                setattr(flock, name, meta[name])
+        for name in CHECKPOINT_ARRAYS:
+            setattr(flock, name, data[name].copy())
+        for cache in ('voronoi_neighbors', 'repel_neighbors'):
+            if f'{cache}_offsets' in data:
+                setattr(flock, cache, tuple(data[f'{cache}_{part}'].copy()
+                                            for part in ('offsets', 'indices', 'images')))
+        if 'order_history' in data:
+            flock.order_history = data['order_history'].tolist()
+    if flock.voronoi_neighbors is not None:
+        flock.kuramoto_matrix = flock.kuramotomatrix(flock.voronoi_neighbors)
+    if meta['rng'] is not None:
+        bit_generator = getattr(np.random, meta['rng']['bit_generator'])()
+        bit_generator.state = meta['rng']
+        flock.rng = np.random.Generator(bit_generator)
+    flock.boidsx = flock.posv[:, 0]
+    flock.boidsy = flock.posv[:, 1]
+    return flock
+
+def run_checkpointed(flockobject, n_frames, path, every=100):
+    """
+    Advances a run to n_frames total frames, saving a checkpoint every
+    `every` frames and at the end. If path already holds a checkpoint the
+    run resumes from it instead of from flockobject. Returns the flock.
+    """
+    if os.path.exists(path):
+        flockobject = load_checkpoint(path)
+        print(f"Resuming from frame {flockobject.frame_count + 1} of {n_frames}")
+    while flockobject.frame_count + 1 < n_frames:
+        flockobject.update1(flockobject.time)
+        if (flockobject.frame_count + 1) % every == 0:
+            save_checkpoint(flockobject, path)
+    save_checkpoint(flockobject, path)
+    return flockobject
+
+
+
+# --- STEADY STATE AND RESULT CACHE ---
+
+class steadystate:
+    """
+    Convergence test on a run's observables (positional entropy and the
+    Kuramoto order_r by default). Keeps the last 2 * window values of each;
+    the run has settled once, for every observable, the means of the older
+    and the newer window differ by at most tol plus z standard errors of
+    that difference. A value still drifting fails it, one that only
+    fluctuates passes. Neighboring frames are correlated, which makes the
+    standard error an underestimate, so the test errs on running longer.
+    """
+    def __init__(self, window=100, tol=0.01, z=2.0, observables=('entropy', 'order_r'), min_frames=0):
+        self.window = window
+        self.tol = tol    # Absolute, a scalar or one per observable
+        self.z = z
+        self.observables = tuple(observables)
+        self.min_frames = min_frames
+        self.history = np.zeros((len(self.observables), 2 * window))
+        self.count = 0        # Values recorded so far
+        self.settled = None   # Index of the value at which the run settled
+
+    def update(self, values):
+        """Records one frame's values (a dict with every observable); returns True once settled."""
+        w = self.window
+        self.history[:, self.count % (2 * w)] = [values[name] for name in self.observables]
+        self.count += 1
+        if self.settled is None and self.count >= max(2 * w, self.min_frames):
+            # Oldest first: the ring's write position is where the older window starts
+            recent = np.roll(self.history, -(self.count % (2 * w)), axis=1)
+            old, new = recent[:, :w], recent[:, w:]
+            drift = np.abs(new.mean(axis=1) - old.mean(axis=1))
+            noise = np.sqrt((old.var(axis=1) + new.var(axis=1)) / w)
+            if (drift <= self.tol + self.z * noise).all():
+                self.settled = self.count - 1
+        return self.settled is not None
+
+def steadyvalues(flockobject, entropy):
+    """The observables a steadystate can watch, for a flock's current state."""
+    return {'entropy': entropy, 'order_r': order_parameter(flockobject.theta),
+            'polarization': polarization(flockobject.velv)}
+
+# Everything that defines a seeded run besides the seed (see resultkey)
+CACHE_PARAMS = ['number', 'width', 'height', 'depth', 'time', 'maxvel', 'maxacc', 'alignp',
+                'cenp', 'repp', 'angle', 'rr', 'topok', 'nearest', 'margin', 'skin',
+                'certify_band', 'recalc_interval', 'adaptive', 'substep_dv', 'substep_dphase',
+                'max_substeps', 'dim']
+
+def codeversion():
+    """Hash of this module's source, so cached results go stale whenever the engine changes."""
+    global CODEVERSION
+    if CODEVERSION is None:
+        with open(__file__, 'rb') as f:
+            CODEVERSION = hashlib.sha256(f.read()).hexdigest()[:16]
+    return CODEVERSION
+
+CODEVERSION = None
+
+def resultkey(kind, flockobject, seed, **settings):
+    """
+    Cache key of a run: a hash of what produced it (kind), every parameter
+    of the freshly seeded flock, the seed, any run settings (frame count,
+    steady state, ...) and the code version.
+    """
+    key = {name: getattr(flockobject, name) for name in CACHE_PARAMS}
+    key.update(kind=kind, seed=seed, dtype=flockobject.dtype.name, code=codeversion(), **settings)
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+class resultcache:
+    """
+    Finished results on disk, one .npz of named arrays per resultkey() in
+    `directory`. Every hit touches its file, and a put() that takes the
+    directory past max_bytes deletes the least recently used entries until
+    it fits again.
+    """
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """The arrays stored under key as a dict, or None on a miss."""
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                result = {name: data[name] for name in data.files}
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return result
+
+    def put(self, key, **arrays):
+        """Stores arrays under key (written to a temporary file and renamed), then evicts."""
+        path = self.path(key)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        """Deletes least recently used entries while the cache is over max_bytes."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+def cached_run(nb, seed, n_frames, cache, steady=None, **params):
+    """
+    create_frame for seeded_flock(nb, seed, **params), read from the cache
+    (a resultcache or its directory) when the same run was done before.
+    steady is a dict of steadystate arguments. Returns (frames, entropy
+    history).
+    """
+    if isinstance(cache, str):
+        cache = resultcache(cache)
+    flock = seeded_flock(nb, seed, **params)
+    key = resultkey('create_frame', flock, seed, frames=n_frames, steady=steady)
+    hit = cache.get(key)
+    if hit is not None:
+        return hit['frames'], hit['entropy']
+    frames, entropy = create_frame(flock, n_frames, None if steady is None else steadystate(**steady))
+    cache.put(key, frames=frames, entropy=entropy)
+    return frames, entropy
+
+
+# --- PARAMETER SWEEPS ---
+
+SWEEP_COLUMNS = ['frame', 'entropy', 'polarization', 'order_r']
+
+def sweep_run(params, seed, nb, frames, every, steady=None):
+    """
+    Runs one seeded boidflock simulation with the given constructor
+    parameters and returns only its summary time series: one row of
+    SWEEP_COLUMNS every `every` frames. No trajectory leaves the worker.
+    steady is a dict of steadystate arguments; the run then ends at the
+    first settled row, its window counting rows rather than frames.
+    """
+    flock = seeded_flock(nb, seed, **params)
+    check = None if steady is None else steadystate(**steady)
+    rows = []
+    for i in range(frames):
+        flock.update1(flock.time)
+        if i % every == 0 or i == frames - 1:
+            rows.append((i, calculate_entropy(flock.posv, flock.width, flock.height),
+                         polarization(flock.velv), order_parameter(flock.theta)))
+            if check is not None and check.update(dict(zip(SWEEP_COLUMNS, rows[-1]))):
+                break
+    return np.array(rows, dtype=np.float64).reshape(-1, len(SWEEP_COLUMNS))
+
+def run_sweep(grid, seeds, nb=50, frames=900, every=10, workers=None, steady=None, cache=None):
+    """
+    Runs every combination of the parameter grid (a dict of boidflock keyword
+    -> list of values, e.g. {'alignp': [0.5, 1], 'angle': [np.pi/4, np.pi/2]})
+    for every seed, spread over a ProcessPoolExecutor. Returns one structured
+    results table with a row per sampled frame of every run: run, seed, the
+    swept parameters, then SWEEP_COLUMNS.
+
+    steady (steadystate arguments) lets each run stop once it has settled,
+    see sweep_run. With a cache (a resultcache or its directory) runs done
+    before are read back instead of simulated, and new ones are stored.
+
+    Workers are forked where the platform allows it, so this also works
+    when boidflock was defined in a notebook or script rather than a module.
+    """
+    names = list(grid)
+    combos = [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+    jobs = [(params, seed) for params in combos for seed in seeds]
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    if isinstance(cache, str):
+        cache = resultcache(cache)
+
+    results = [None] * len(jobs)
+    keys = [None] * len(jobs)
+    if cache is not None:
+        for run, (params, seed) in enumerate(jobs):
+            keys[run] = resultkey('sweep_run', seeded_flock(nb, seed, **params), seed,
+                                  frames=frames, every=every, steady=steady)
+            hit = cache.get(keys[run])
+            if hit is not None:
+                results[run] = hit['series']
+    todo = [run for run in range(len(jobs)) if results[run] is None]
+    if len(todo) < len(jobs):
+        print(f"Sweep: {len(jobs) - len(todo)}/{len(jobs)} runs read from the cache")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = {pool.submit(sweep_run, *jobs[run], nb, frames, every, steady): run for run in todo}
+        for done, future in enumerate(as_completed(futures), 1):
+            run = futures[future]
+            results[run] = future.result()
+            if cache is not None:
+                cache.put(keys[run], series=results[run])
+            print(f"\rSweep: {done}/{len(todo)} runs finished", end='')
+    print()
+
+    dtype = ([('run', np.int64), ('seed', np.int64)]
+             + [(name, np.float64) for name in names]
+             + [(col, np.float64) for col in SWEEP_COLUMNS])
+    table = np.zeros(sum(len(r) for r in results), dtype=dtype)
+    start = 0
+    for run, ((params, seed), series) in enumerate(zip(jobs, results)):
+        rows = table[start:start + len(series)]
+        rows['run'] = run
+        rows['seed'] = seed
+        for name in names:
+            rows[name] = params[name]
+        for k, col in enumerate(SWEEP_COLUMNS):
+            rows[col] = series[:, k]
+        start += len(series)
+    return table
+
+
+# --- REDUCED PRECISION ---
+
+def drift_check(nb=50, seed=0, frames=900, every=10, dtype=np.float32, **params):
+    """
+    Runs the same seeded flock twice, in float64 and in the given reduced
+    precision, and compares the SWEEP_COLUMNS observables every `every`
+    frames. Individual trajectories part ways quickly (the dynamics are
+    chaotic), so what matters is whether the summary observables stay
+    statistically the same. Prints the mean and largest absolute
+    difference of each and returns a structured table with frame, then
+    <name>_64, <name>_lo and <name>_drift for each observable.
+    """
+    reference = sweep_run({**params, 'dtype': np.float64}, seed, nb, frames, every)
+    reduced = sweep_run({**params, 'dtype': dtype}, seed, nb, frames, every)
+    names = SWEEP_COLUMNS[1:]
+    table = np.zeros(len(reference), dtype=[('frame', np.int64)] + [
+        (f'{name}_{kind}', np.float64) for name in names for kind in ('64', 'lo', 'drift')])
+    table['frame'] = reference[:, 0]
+    print(f"{np.dtype(dtype).name} vs float64, N={nb}, seed={seed}, {frames} frames")
+    for k, name in enumerate(names, 1):
+        table[f'{name}_64'] = reference[:, k]
+        table[f'{name}_lo'] = reduced[:, k]
+        table[f'{name}_drift'] = drift = np.abs(reduced[:, k] - reference[:, k])
+        worst = np.argmax(drift)
+        print(f"{name:>14}: mean |drift| {drift.mean():.4f}, "
+              f"max {drift[worst]:.4f} at frame {int(table['frame'][worst])}")
+    return table
+
+
+class rasterizer:
+    """
+    Draws [x, y, phase] frames straight into an RGB uint8 buffer, with no
+    matplotlib artists involved. Each boid is a filled disc whose area
+    follows map_phase_to_size in points^2, like the scatter plot of an 8 inch
+    wide figure, and overlapping discs are alpha-blended over black.
+    """
+    def __init__(self, width, height, pixels=960, color=(0, 255, 255), alpha=0.8,
+                 min_size=20, max_size=250, chunk=4096):
+        self.width = width
+        self.height = height
+        self.px = pixels
+        self.py = 2 * int(round(pixels * height / width / 2)) # ffmpeg's yuv420p wants even sizes
+        self.pt = pixels / 8 / 72  # pixels per point
+        self.color = np.array(color, dtype=np.float64)
+        self.alpha = alpha
+        self.min_size = min_size
+        self.max_size = max_size
+        self.chunk = chunk
+        # Pixel offsets of the largest disc, reused for every boid
+        rmax = np.sqrt(max_size) / 2 * self.pt
+        R = int(np.ceil(rmax))
+        dy, dx = np.mgrid[-R:R + 1, -R:R + 1]
+        dist = np.hypot(dx, dy)
+        inside = dist <= rmax
+        self.dx, self.dy, self.dist = dx[inside], dy[inside], dist[inside]
+        self.frame = np.zeros((self.py, self.px, 3), dtype=np.uint8)
+
+    def draw(self, frame):
+        """Rasterizes one frame and returns the (reused) RGB buffer."""
+        cx = np.floor(frame[:, 0] / self.width * self.px).astype(np.int64)
+        cy = np.floor((1 - frame[:, 1] / self.height) * self.py).astype(np.int64)
+        r = np.sqrt(map_phase_to_size(frame[:, -1], self.min_size, self.max_size)) / 2 * self.pt
+        coverage = np.zeros(self.px * self.py, dtype=np.int64)
+        for s in range(0, len(frame), self.chunk):
+            inside = self.dist[None, :] <= r[s:s + self.chunk, None]
+            x = (cx[s:s + self.chunk, None] + self.dx[None, :])[inside]
+            y = (cy[s:s + self.chunk, None] + self.dy[None, :])[inside]
+            onscreen = (x >= 0) & (x < self.px) & (y >= 0) & (y < self.py)
+            coverage += np.bincount(y[onscreen] * self.px + x[onscreen], minlength=coverage.size)
+        # k discs of the same colour with opacity a leave 1 - (1 - a)^k of it
+        intensity = 1 - (1 - self.alpha) ** coverage.reshape(self.py, self.px)
+        np.multiply(intensity[..., None], self.color, out=self.frame, casting='unsafe')
+        return self.frame
+
+class videoencoder:
+    """
+    Rasterizes frames one at a time and pipes the raw RGB bytes to an
+    ffmpeg subprocess on stdin. close() waits for ffmpeg, then prints and
+    returns the frames-per-second throughput.
+    """
+    def __init__(self, path, width, height, fps=20, pixels=960, ffmpeg='ffmpeg'):
+        self.path = path
+        self.raster = rasterizer(width, height, pixels)
+        cmd = [ffmpeg, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{self.raster.px}x{self.raster.py}',
+               '-r', str(fps), '-i', '-',
+               '-c:v', 'libx264', '-pix_fmt', 'yuv420p', path]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        self.count = 0
+        self.start = time.perf_counter()
+
+    def write(self, frame):
+        self.proc.stdin.write(self.raster.draw(frame).data)
+        self.count += 1
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+        elapsed = time.perf_counter() - self.start
+        if self.proc.returncode:
+            raise RuntimeError(f"ffmpeg exited with code {self.proc.returncode}")
+        throughput = self.count / elapsed if elapsed > 0 else float('inf')
+        print(f"Rendered {self.count} frames to {self.path} in {elapsed:.1f} s ({throughput:.1f} frames/s)")
+        return throughput
+
+def render_video(frames, path, width, height, fps=20, pixels=960, ffmpeg='ffmpeg'):
+    """
+    Renders frames (from stream_frames, create_frame or open_trajectory)
+    through a videoencoder. Returns the frames-per-second throughput.
+    """
+    encoder = videoencoder(path, width, height, fps, pixels, ffmpeg)
+    try:
+        for frame in frames:
+            encoder.write(frame)
+    finally:
+        throughput = encoder.close()
+    return throughput
+
+def animate(i, all_frame_data, scatter_plot):
+    """Function called by FuncAnimation on each frame to UPDATE the plot."""
+    current_frame_data = all_frame_data[i]
+    scatter_plot.set_offsets(current_frame_data[:, 0:2])
+    sizes = map_phase_to_size(current_frame_data[:, -1])
+    scatter_plot.set_sizes(sizes)
+    return scatter_plot,
+
+
+# --- PIPELINE ---
+
+class entropyrecorder:
+    """Frame sink recording the positional entropy of every frame with an occupancygrid."""
+    def __init__(self, n_frames, width, height, grid_size=30):
+        self.occupancy = occupancygrid(width, height, grid_size)
+        self.history = np.zeros(n_frames)
+        self.count = 0
+
+    def write(self, frame):
+        self.occupancy.update(frame[:, 0:2])
+        self.history[self.count] = self.occupancy.entropy()
+        self.count += 1
+
+    def close(self):
+        return self.history[:self.count]
+
+class framestore:
+    """Frame sink keeping every frame in memory, like create_frame's frame_data."""
+    def __init__(self, n_frames, flockobject):
+        self.frames = np.zeros((n_frames, flockobject.number, flockobject.dim + 1), dtype=flockobject.dtype)
+        self.count = 0
+
+    def write(self, frame):
+        self.frames[self.count] = frame
+        self.count += 1
+
+    def close(self):
+        return self.frames[:self.count]
+
+class framering:
+    """
+    A bounded ring of preallocated frame buffers between one producer and
+    several consumers. Every consumer sees every frame in order, and a slot
+    only goes back to the producer once all consumers are done with it, so
+    a lagging consumer makes the producer wait rather than frames piling up.
+    Slots are released in frame order, so slot i % slots is always the free one.
+    """
+    def __init__(self, slots, shape, dtype, consumers):
+        self.buffers = np.empty((slots,) + shape, dtype=dtype)
+        self.free = threading.Semaphore(slots)
+        self.queues = [queue.Queue() for _ in range(consumers)]
+        self.pending = [0] * slots
+        self.lock = threading.Lock()
+        self.count = 0
+        self.failed = None  # First exception raised by a consumer
+
+    def claim(self):
+        """Waits for a free slot and returns its buffer."""
+        self.free.acquire()
+        return self.buffers[self.count % len(self.buffers)]
+
+    def publish(self):
+        """Hands the claimed buffer to every consumer."""
+        slot = self.count % len(self.buffers)
+        self.count += 1
+        if not self.queues:
+            self.free.release()
+            return
+        self.pending[slot] = len(self.queues)
+        for q in self.queues:
+            q.put(slot)
+
+    def finish(self):
+        for q in self.queues:
+            q.put(None)
+
+    def release(self, slot):
+        with self.lock:
+            self.pending[slot] -= 1
+            if self.pending[slot] == 0:
+                self.free.release()
+
+    def consume(self, k, sink):
+        """Consumer thread body: feeds frames to sink.write until finish()."""
+        while True:
+            slot = self.queues[k].get()
+            if slot is None:
+                return
+            # After a failure keep draining, so the producer never blocks on a dead consumer
+            if self.failed is None:
+                try:
+                    sink.write(self.buffers[slot])
+                except BaseException as e:
+                    self.failed = e
+            self.release(slot)
+
+def run_pipeline(flockobject, n_frames, sinks, slots=8):
+    """
+    Simulates n_frames in this thread while every sink (anything with
+    write(frame) and close(): trajectorywriter, videoencoder,
+    entropyrecorder, framestore) consumes earlier frames in a thread of its
+    own, through a framering of `slots` buffers. Qhull, most of numpy and
+    the ffmpeg pipe release the GIL, so a long run takes about as long as
+    its slowest stage rather than the sum of them. Returns the sinks'
+    close() results in order.
+    """
+    ring = framering(slots, (flockobject.number, flockobject.dim + 1), flockobject.dtype, len(sinks))
+    workers = [threading.Thread(target=ring.consume, args=(k, sink), daemon=True)
+               for k, sink in enumerate(sinks)]
+    for worker in workers:
+        worker.start()
+    try:
+        for i in range(n_frames):
+            frame = ring.claim()
+            if ring.failed is not None:
+                break
+            flockobject.update1(flockobject.time)
+            flockobject.frame(frame)
+            ring.publish()
+    except BaseException:
+        # Still close every sink, so ffmpeg gets its EOF and a trajectory
+        # its flushed header, then raise the simulation's error
+        ring.finish()
+        for worker in workers:
+            worker.join()
+        closesinks(sinks)
+        raise
+    ring.finish()
+    for worker in workers:
+        worker.join()
+    if ring.failed is not None:
+        closesinks(sinks)  # the consumer's own error is the one worth raising
+        raise ring.failed
+    return [sink.close() for sink in sinks]
+
+def closesinks(sinks):
+    """Closes every sink on an error path, ignoring their own errors."""
+    for sink in sinks:
+        try:
+            sink.close()
+        except Exception:
+            pass
+
+
+# --- COMMAND LINE ---
+
+# Everything a headless run can be configured with; a JSON config file and
+# command-line flags override these, in that order. Output paths left as
+# None are not written.
+DEFAULT_CONFIG = {
+    'n': 50, 'width': 300, 'height': 300, 'dt': .05,
+    'alignp': 1.0, 'cenp': 1.0, 'repp': 2.0, 'skin': None, 'topok': None,
+    'dim': 2, 'depth': None, 'nearest': None, 'adaptive': False, 'workers': None,
+    'frames': 900, 'seed': None, 'dtype': 'float64',
+    'trajectory': None, 'entropy': None, 'video': None, 'plot': None, 'profile': None,
+    'drift': None,
+    'fps': 20, 'ffmpeg': 'ffmpeg',
+}
+
+def save_entropy_plot(entropy_history, path):
+    """Saves the entropy-over-time plot of the notebook demo to an image file."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(10, 5))
+    ax.plot(entropy_history)
+    ax.set_xlabel("Frame Number")
+    ax.set_ylabel("Positional Entropy (bits)")
+    ax.set_title("Positional Entropy of the Flock Over Time")
+    ax.grid(True)
+    fig.savefig(path)
+    plt.close(fig)
+
+def run_config(config):
+    """
+    Runs one headless simulation from a config dict (see DEFAULT_CONFIG) and
+    writes the requested outputs. Frames go straight to disk when a
+    trajectory path is given and are kept in memory otherwise. Returns
+    (frames, entropy history).
+    """
+    config = {**DEFAULT_CONFIG, **config}
+    if config['seed'] is None:
+        # Pick one now so the drift check can rerun the same initial conditions
+        config['seed'] = int(np.random.SeedSequence().entropy % 2**32)
+    params = dict(w=config['width'], h=config['height'], dt=config['dt'],
+                  alignp=config['alignp'], cenp=config['cenp'], repp=config['repp'],
+                  skin=config['skin'], topok=config['topok'], dim=config['dim'],
+                  depth=config['depth'], nearest=config['nearest'], adaptive=config['adaptive'])
+    flockobject = seeded_flock(config['n'], config['seed'], dtype=config['dtype'], **params)
+    if config['workers'] and config['profile']:
+        raise ValueError("profile times a single-process run; drop workers")
+    if config['profile']:
+        stageprofiler(flockobject)
+    if config['workers']:
+        flockobject = domainflock(flockobject, config['workers'])
+
+    # Simulation, entropy, storage and video encoding overlap in a run_pipeline
+    n_frames = config['frames']
+    sinks = [entropyrecorder(n_frames, flockobject.width, flockobject.height)]
+    if config['trajectory']:
+        sinks.append(trajectorywriter(config['trajectory'], n_frames, flockobject))
+    else:
+        sinks.append(framestore(n_frames, flockobject))
+    if config['video']:
+        sinks.append(videoencoder(config['video'], flockobject.width, flockobject.height,
+                                  fps=config['fps'], ffmpeg=config['ffmpeg']))
+    try:
+        results = run_pipeline(flockobject, n_frames, sinks)
+    finally:
+        if config['workers']:
+            flockobject.close()
+    entropy_history, frames = results[0], results[1]
+    if config['trajectory']:
+        frames = frames[0]
+
+    if config['entropy']:
+        if config['entropy'].endswith('.npy'):
+            np.save(config['entropy'], entropy_history)
+        else:
+            np.savetxt(config['entropy'], entropy_history, header='entropy')
+    if config['plot']:
+        save_entropy_plot(entropy_history, config['plot'])
+    if config['profile']:
+        flockobject.profiler.summary()
+        flockobject.profiler.write_trace(config['profile'])
+    if config['drift']:
+        table = drift_check(config['n'], config['seed'], n_frames, dtype=flockobject.dtype, **params)
+        np.savetxt(config['drift'], np.column_stack([table[name] for name in table.dtype.names]),
+                   header=' '.join(table.dtype.names))
+    return frames, entropy_history
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Runs the boids simulation headless.")
+    parser.add_argument('--config', help='JSON file with any of the keys below')
+    parser.add_argument('--n', type=int, help='number of boids')
+    parser.add_argument('--width', type=float)
+    parser.add_argument('--height', type=float)
+    parser.add_argument('--dim', type=int, choices=[2, 3])
+    parser.add_argument('--depth', type=float, help='z size of a 3D box (default: width)')
+    parser.add_argument('--dt', type=float)
+    parser.add_argument('--adaptive', action='store_true', default=None,
+                        help='split each dt into bounded substeps, so dt can be the output interval')
+    parser.add_argument('--alignp', type=float, help='alignment weight')
+    parser.add_argument('--cenp', type=float, help='cohesion weight')
+    parser.add_argument('--repp', type=float, help='separation weight')
+    parser.add_argument('--skin', type=float, help='Verlet skin for adaptive neighbor rebuilds')
+    parser.add_argument('--topok', type=int, help='repel from the k nearest boids')
+    parser.add_argument('--nearest', type=int,
+                        help='align/cohere with the k nearest boids instead of Voronoi (3D default 7)')
+    parser.add_argument('--workers', type=int,
+                        help='split a 2D float64 box into this many strips, one process each')
+    parser.add_argument('--frames', type=int)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--dtype', choices=['float64', 'float32'],
+                        help='float32 halves memory traffic; check it with --drift')
+    parser.add_argument('--trajectory', help='.npy file to stream [x, y, phase] frames into')
+    parser.add_argument('--entropy', help='entropy history, .npy or text')
+    parser.add_argument('--video', help='.mp4 rendered with ffmpeg')
+    parser.add_argument('--plot', help='entropy plot image (needs matplotlib)')
+    parser.add_argument('--profile', help='Chrome trace JSON of the update1 stages')
+    parser.add_argument('--drift', help='text table of observables vs a float64 rerun (see drift_check)')
+    parser.add_argument('--fps', type=int)
+    parser.add_argument('--ffmpeg', help='ffmpeg executable')
+    args = vars(parser.parse_args(argv))
+
+    config = {}
+    path = args.pop('config')
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        parser.error(f"unknown config keys: {', '.join(sorted(unknown))}")
+    config.update({k: v for k, v in args.items() if v is not None})
+    run_config(config)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,159 +1,447 @@
 from p5 import*
-import random as ra
+import time
 import numpy as np
-class Boid():
+import cmath
+
+
+class RowVector(Vector):
+    # the Vector a vectorfield hands out: it stays tied to its row of the
+    # flock array, so changing it in place (boid.position.x=0,
+    # boid.velocity.normalize(), boid.position[0]=0, ...) writes the row
+    # too. results of arithmetic on it are not tied to any row
+    row=None
+
+    def __setattr__(self,name,value):
+        Vector.__setattr__(self,name,value)
+        if self.row is not None and name!='row':
+            self.row[:]=(self.x,self.y)
+
+    def __setitem__(self,key,value):
+        Vector.__setitem__(self,key,value)
+        if self.row is not None:
+            self.row[:]=(self.x,self.y)
+
+
+def vectorfield(name):
+    # a Boid attribute backed by one row of a Flock array, handed out as a
+    # RowVector view of that row
+    def get(self):
+        row=getattr(self.flock,name)[self.i]
+        v=RowVector(*row)
+        v.row=row
+        return v
+    def put(self,v):
+        getattr(self.flock,name)[self.i]=(v.x,v.y)
+    return property(get,put)
+
+
+def rowfield(name):
+    # a per-boid number stored in a Flock array
+    def get(self):
+        return getattr(self.flock,name)[self.i]
+    def put(self,value):
+        getattr(self.flock,name)[self.i]=value
+    return property(get,put)
+
+
+def flockfield(name):
+    # a setting shared by the whole flock
+    return property(lambda self:getattr(self.flock,name))
+
+
+def unit(v):
+    n=np.sqrt(v@v)
+    return v/n if n!=0 else v
+
+
+def unitrows(v):
+    # unit() for every row of v at once; zero rows stay zero
+    n=np.sqrt((v**2).sum(axis=1))
+    return np.divide(v,n[:,None],out=np.zeros_like(v),where=n[:,None]!=0)
+
+
+def closepairs(pos,r):
+    # every (i,j) pair of boids closer than r but not on top of each other,
+    # both ways round: boids are sorted by square cells of side r and each
+    # is matched against its own and the 8 next cells
+    cell=np.floor(pos/r).astype(int)
+    cell-=cell.min(axis=0)-1
+    rows=cell[:,1].max()+2
+    key=cell[:,0]*rows+cell[:,1]
+    order=np.argsort(key,kind='stable')
+    sortedkey=key[order]
+    I=[]
+    J=[]
+    for dx in (-1,0,1):
+        for dy in (-1,0,1):
+            target=key+dx*rows+dy
+            lo=np.searchsorted(sortedkey,target,'left')
+            count=np.searchsorted(sortedkey,target,'right')-lo
+            start=np.repeat(lo-np.cumsum(count)+count,count)
+            I.append(np.repeat(np.arange(len(pos)),count))
+            J.append(order[np.arange(count.sum())+start])
+    i=np.concatenate(I)
+    j=np.concatenate(J)
+    d2=((pos[i]-pos[j])**2).sum(axis=1)
+    keep=(d2<r*r)&(d2>0)
+    return i[keep],j[keep]
 
-    def __init__(self, x, y,radiusvel=50 ,radiuscohe=50,rradiusrep=10,width=640, height=360, radiuskura=10):
-    
-        self.position = Vector(x, y)
-        angle=(ra.uniform(0,2*3.14))
-        self.velocity=Vector(5*cos(angle),5*sin(angle))
-        self.acceleration=Vector(0,0)
-        self.rv=radiusvel
-        self.rc=radiuscohe
-        self.rr=rradiusrep
-        self.maxvel=50
-        self.maxacc=10
-        self.width=width
-        self.rku=radiuskura
-        self.height=height
-        self.bright=ra.uniform(0,1)
-        self.frequency=1
-        self.phase=ra.uniform(0,2*3.14)
 
-    def borders(self):
-        if self.position.x>self.width:
-            self.position.x=0
-        if self.position.x<0:
-            self.position.x=self.width
-        if self.position.y>self.width:
-            self.position.y=0
-        if self.position.y<0:
-            self.position.y=self.height
+class Boid():
+    # lightweight view of row i of a Flock; the state and the maths live there
+    __slots__=('flock','i')
+    position=vectorfield('pos')
+    velocity=vectorfield('vel')
+    acceleration=vectorfield('acc')
+    phase=property(lambda self:self.flock.phase[self.i],
+                   lambda self,value:self.flock.setphase(self.i,value))
+    frequency=rowfield('frequency')
+    bright=rowfield('bright')
+    rv=flockfield('rv')
+    rc=flockfield('rc')
+    rr=flockfield('rr')
+    rku=flockfield('rku')
+    maxvel=flockfield('maxvel')
+    maxacc=flockfield('maxacc')
+    width=flockfield('width')
+    height=flockfield('height')
+
+    def __init__(self,flock,i):
+        self.flock=flock
+        self.i=i
 
-            
-        
+    def borders(self):
+        self.flock.borders(self.i)
 
     def newphase_using_kuramoto(self, boids):
-        b=0
-        count=0
-        for boid in boids:
-            d=(self.position-boid.position).magnitude
-            
-            if d<self.rku and d!=0:
-                b+=np.sin(boid.phase-self.phase)
-                count=count+1
-        if count!=0:
-            b=b/count
-            return(b)
-        else :
-            return(b)    
-
-
-        
-
+        return self.steering(boids)[3]
 
     def alignacc(self,boidset):
-        v=Vector(0,0)
-        count=0
-        steer= Vector(0,0)
-        for boid in boidset:
-            if (self.position- boid.position).magnitude<self.rv:
-                v+=boid.velocity
-                count+=1
-        if count>0 and (v-self.velocity).magnitude!=0:    
-            v=(v/count)
-            direction= ((v-self.velocity)/(v-self.velocity).magnitude)  
-             
-            steer+=(direction*(self.maxacc))
-            
-        return steer     
+        return self.steering(boidset)[0]
 
     def seperate(self,boids):
-        steer=Vector(0,0)
-        desveldir=Vector(0,0)
-        for boid in boids :
-            d=(self.position - boid.position ).magnitude 
-            if d<self.rr and d!=0 :
-                direction=(self.position- boid.position).normalize()
-                
-                desveldir+= direction/d
-        if desveldir!=Vector(0,0):
-            desveldir=desveldir.normalize()
-            desveldir*=self.maxvel
-            steer+=((desveldir - self.velocity).normalize())*self.maxacc
-        
-            return steer         
-        else:
-            return steer          
-
-        
+        return self.steering(boids)[1]
 
     def cohesionacc(self,boids):
-        agg= Vector(0,0)
-        count=0
-        steer=Vector(0,0)
-        for boid in boids :
-            d=(self.position-boid.position).magnitude 
-            if d<self.rc:
-                agg+=boid.position
-                count+=1
-
-        if count!=0 and (agg-self.position).magnitude!=0:
-            avgpos=agg/count
-            dessteerdir= (avgpos- self.position).normalize()
-            dessteerdir*=self.maxvel
-            steer+=(dessteerdir-self.velocity).normalize()*self.maxacc
+        return self.steering(boids)[2]
 
-            
-            
-            return steer 
-        else:
-            return steer
-    
+    def steering(self,boidset):
+        a,c,b,d=self.flock.steering(self.i,[boid.i for boid in boidset])
+        return Vector(*a),Vector(*c),Vector(*b),d
 
     def flockeffect(self,boidset,dt=.1,paramalign=1,paramseperate=4,paramcohes=1,):
-        a=self.alignacc(boidset)*paramalign
-        b=self.cohesionacc(boidset)*paramcohes
-
-        c=self.seperate(boidset)*paramseperate
-        d=self.newphase_using_kuramoto(boidset)
-        self.frequency=1+d
-        self.acceleration+=a
-        self.acceleration+=b
-        self.acceleration+=c
-        
-        
+        self.flock.flockeffect(self.i,[boid.i for boid in boidset],paramalign,paramseperate,paramcohes)
+
     def update(self,dt=.1):
-        self.velocity+=self.acceleration*dt
-        
-        self.velocity.limit(self.maxvel)
-        self.phase=self.phase+self.frequency*dt
-        
-        
-        self.position+=self.velocity*dt
-        self.acceleration=Vector(0,0)
+        self.flock.update(self.i,dt)
+
     def run(self, boids,dt=.2):
         self.flockeffect(boids,dt)
         self.borders()
         self.update(dt)
 
-            
+
+class CellGrid:
+    # uniform grid of square cells as wide as the largest interaction radius,
+    # so every boid within range sits in the same or one of the 8 next cells
+    def __init__(self,cellsize):
+        self.cellsize=cellsize
+        self.cells={}
+        self.cellof=[]
+
+    def key(self,position):
+        return (int(position[0]//self.cellsize),int(position[1]//self.cellsize))
+
+    def build(self,pos):
+        self.pos=pos
+        self.cells={}
+        self.cellof=[]
+        for i,cell in enumerate(map(tuple,(pos//self.cellsize).astype(int).tolist())):
+            self.cellof.append(cell)
+            self.cells.setdefault(cell,[]).append(i)
+
+    def move(self,i):
+        # boids update one after another, so re-bin as soon as one moves
+        cell=self.key(self.pos[i])
+        if cell!=self.cellof[i]:
+            self.cells[self.cellof[i]].remove(i)
+            self.cells.setdefault(cell,[]).append(i)
+            self.cellof[i]=cell
+
+    def near(self,i):
+        cx,cy=self.cellof[i]
+        found=[]
+        for dx in (-1,0,1):
+            for dy in (-1,0,1):
+                found.extend(self.cells.get((cx+dx,cy+dy),()))
+        return found
+
+
+class Mesh:
+    # particle-mesh sums for the long-range rules: every boid's values are
+    # spread over the 4 nearest nodes of a grid of `cell` px squares (cloud
+    # in cell), summed over a disk of radius r by one fft convolution, and
+    # read back at each boid with the same weights. that costs O(n + g log g)
+    # whatever the radius, for an error that shrinks with the cell size (see
+    # Flock.mesherror). the grid runs `pad` px past every edge so the fft's
+    # wrap-around never reaches across the box, like the exact search
+    def __init__(self,width,height,cell,pad):
+        self.cell=cell
+        self.pad=pad
+        self.shape=(int(np.ceil((width+2*pad)/cell))+1,int(np.ceil((height+2*pad)/cell))+1)
+        self.kernels={}
+
+    def kernel(self,r):
+        # the disk of radius r around node (0,0), wrapped around, each node
+        # weighted by how much of its cell the disk covers (4x4 samples),
+        # and its fft
+        if r not in self.kernels:
+            nx,ny=self.shape
+            dx=np.minimum(np.arange(nx),nx-np.arange(nx))
+            dy=np.minimum(np.arange(ny),ny-np.arange(ny))
+            disk=np.zeros(self.shape)
+            for ox in np.arange(-.375,.5,.25):
+                for oy in np.arange(-.375,.5,.25):
+                    disk+=((dx[:,None]+ox)**2+(dy[None,:]+oy)**2)*self.cell**2<r*r
+            disk/=16
+            self.kernels[r]=(disk,np.fft.rfft2(disk))
+        return self.kernels[r]
+
+    def bind(self,pos):
+        # nodes and cloud-in-cell weights of every boid, once per step
+        g=np.clip((pos+self.pad)/self.cell,0,np.array(self.shape)-1.001)
+        i=np.floor(g).astype(int)
+        f=g-i
+        ny=self.shape[1]
+        self.nodes=[(i[:,0]+a)*ny+i[:,1]+b for a in (0,1) for b in (0,1)]
+        self.weights=[(f[:,0] if a else 1-f[:,0])*(f[:,1] if b else 1-f[:,1]) for a in (0,1) for b in (0,1)]
+
+    def sums(self,values,r):
+        # for every boid, each column of values summed over the boids within
+        # r of it, itself included
+        size=self.shape[0]*self.shape[1]
+        grid=np.zeros((values.shape[1],size))
+        for node,w in zip(self.nodes,self.weights):
+            for k in range(values.shape[1]):
+                grid[k]+=np.bincount(node,weights=w*values[:,k],minlength=size)
+        grid=np.fft.irfft2(np.fft.rfft2(grid.reshape(-1,*self.shape))*self.kernel(r)[1],s=self.shape)
+        grid=grid.reshape(len(grid),-1)
+        return sum(w[:,None]*grid[:,node].T for node,w in zip(self.nodes,self.weights))
+
+    def selfweight(self,r):
+        # the share of each boid's own values that sums(values,r) hands back to it
+        disk=self.kernel(r)[0]
+        corners=[(a,b) for a in (0,1) for b in (0,1)]
+        return sum(wi*wj*disk[abs(ai-aj),abs(bi-bj)]
+                   for (ai,bi),wi in zip(corners,self.weights)
+                   for (aj,bj),wj in zip(corners,self.weights))
+
+
 class Flock:
-    def __init__(self, count=150, width=300, height=300):
+    # struct-of-arrays flock: one row per boid in each array, flock.boids are views.
+    # mesh=cell size in px swaps the exact long-range rules for Mesh sums
+    def __init__(self, count=150, width=300, height=300, seed=None, mesh=None):
         self.width = width
         self.height = height
-        self.boids = []
-        for i in range(count):
-            boid = Boid(ra.uniform(0,width), ra.uniform(0,height))
-            boid.width = width
-            boid.height = height
-            self.boids.append(boid)
-
-    def run(self):
-        for boid in self.boids:
-            
-            boid.run(self.boids)
+        self.rv=50
+        self.rc=50
+        self.rr=10
+        self.rku=10
+        self.maxvel=50
+        self.maxacc=10
+
+        rng=np.random.default_rng(seed)
+        self.pos=np.column_stack((rng.uniform(0,width,count),rng.uniform(0,height,count)))
+        angle=rng.uniform(0,2*3.14,count)
+        self.vel=5*np.column_stack((np.cos(angle),np.sin(angle)))
+        self.acc=np.zeros((count,2))
+        self.bright=rng.uniform(0,1,count)
+        self.frequency=np.ones(count)
+        self.phase=rng.uniform(0,2*3.14,count)
+        # e^{i phase} per boid: sin(pj-pi) is Im(conj(zi)*zj), so the coupling
+        # needs no per-pair sin, and |mean z| is the Kuramoto order parameter r
+        self.z=np.exp(1j*self.phase)
+        self.localr=np.zeros(count)
+        self.r=abs(self.z.mean())
+        self.order=[]
+        self.boids=[Boid(self,i) for i in range(count)]
+        self.mesh=Mesh(width,height,mesh,max(self.rv,self.rc,self.rku)) if mesh else None
+
+    def steering(self,i,cand):
+        # one pass over the candidate rows feeds every rule at once
+        cand=np.asarray(cand,dtype=int)
+        p=self.pos[i]
+        v=self.vel[i]
+        offset=p-self.pos[cand]
+        d=np.sqrt((offset**2).sum(axis=1))
+
+        align=np.zeros(2)
+        near=d<self.rv
+        count=near.sum()
+        vsum=self.vel[cand[near]].sum(axis=0)
+        if count>0 and (vsum!=v).any():
+            align=unit(vsum/count-v)*self.maxacc
+
+        seperate=np.zeros(2)
+        near=(d<self.rr)&(d!=0)
+        desveldir=(offset[near]/d[near,None]**2).sum(axis=0)
+        if (desveldir!=0).any():
+            seperate=unit(unit(desveldir)*self.maxvel-v)*self.maxacc
+
+        cohesion=np.zeros(2)
+        near=d<self.rc
+        count=near.sum()
+        agg=self.pos[cand[near]].sum(axis=0)
+        if count!=0 and (agg!=p).any():
+            cohesion=unit(unit(agg/count-p)*self.maxvel-v)*self.maxacc
+
+        b=0
+        near=(d<self.rku)&(d!=0)
+        if near.any():
+            zmean=self.z[cand[near]].mean()
+            b=(self.z[i].conjugate()*zmean).imag
+            self.localr[i]=abs(zmean)
+        else:
+            self.localr[i]=0
+        return align,seperate,cohesion,b
+
+    def flockeffect(self,i,cand,paramalign=1,paramseperate=4,paramcohes=1):
+        a,c,b,d=self.steering(i,cand)
+        self.frequency[i]=1+d
+        self.acc[i]+=a*paramalign
+        self.acc[i]+=b*paramcohes
+        self.acc[i]+=c*paramseperate
+
+    def borders(self,i):
+        p=self.pos[i]
+        if p[0]>self.width:
+            p[0]=0
+        if p[0]<0:
+            p[0]=self.width
+        if p[1]>self.width:
+            p[1]=0
+        if p[1]<0:
+            p[1]=self.height
+
+    def update(self,i,dt=.1):
+        self.vel[i]+=self.acc[i]*dt
+        speed=np.sqrt(self.vel[i]@self.vel[i])
+        if speed>self.maxvel:
+            self.vel[i]*=self.maxvel/speed
+        self.setphase(i,self.phase[i]+self.frequency[i]*dt)
+        self.pos[i]+=self.vel[i]*dt
+        self.acc[i]=0
+
+    def setphase(self,i,value):
+        self.phase[i]=value
+        self.z[i]=cmath.exp(1j*value)
+
+    def run(self,dt=.2):
+        if self.mesh is not None:
+            return self.runmesh(dt)
+        # bin the boids once per step; each boid only looks at its 3x3 cells
+        self.grid=CellGrid(max(self.rv,self.rc,self.rr,self.rku))
+        self.grid.build(self.pos)
+        self.z=np.exp(1j*self.phase)
+        for i in range(len(self.boids)):
+            self.flockeffect(i,self.grid.near(i))
+            self.borders(i)
+            self.update(i,dt)
+            self.grid.move(i)
+        self.r=abs(self.z.mean())
+        self.order.append(self.r)
+
+    def meshforces(self,rows=slice(None)):
+        # the rules for the boids in rows (all by default) at once, from the
+        # state as it stands: alignment, cohesion and a long-range kuramoto
+        # coupling from mesh sums over the whole flock, separation and a
+        # short-range coupling exact
+        n=len(self.pos)
+        p=self.pos
+        v=self.vel
+        ones=np.ones((n,1))
+        self.mesh.bind(p)
+
+        far=self.mesh.sums(np.hstack((ones,v)),self.rv)
+        count,vsum=far[:,0],far[:,1:]
+        align=np.zeros((n,2))
+        has=count>.5
+        align[has]=unitrows(vsum[has]/count[has,None]-v[has])*self.maxacc
+
+        i,j=closepairs(p,self.rr)
+        offset=p[i]-p[j]
+        push=offset/(offset**2).sum(axis=1)[:,None]
+        desveldir=np.column_stack([np.bincount(i,weights=push[:,k],minlength=n) for k in (0,1)])
+        seperate=np.zeros((n,2))
+        has=(desveldir!=0).any(axis=1)
+        seperate[has]=unitrows(unitrows(desveldir[has])*self.maxvel-v[has])*self.maxacc
+
+        far=self.mesh.sums(np.hstack((ones,p)),self.rc)
+        count,agg=far[:,0],far[:,1:]
+        cohesion=np.zeros((n,2))
+        has=count>.5
+        cohesion[has]=unitrows(unitrows(agg[has]/count[has,None]-p[has])*self.maxvel-v[has])*self.maxacc
+
+        if self.rku<min(self.rv,self.rc):
+            # a coupling radius as short as separation's is summed exactly over
+            # the close pairs: it has too few boids in it for the mesh to get right
+            if self.rku!=self.rr:
+                i,j=closepairs(p,self.rku)
+            count=np.bincount(i,minlength=n).astype(float)
+            zsum=np.bincount(i,weights=self.z[j].real,minlength=n)+1j*np.bincount(i,weights=self.z[j].imag,minlength=n)
+        else:
+            # the mesh sum holds each boid itself, the exact rule does not
+            far=self.mesh.sums(np.column_stack((ones,self.z.real,self.z.imag)),self.rku)
+            own=self.mesh.selfweight(self.rku)
+            count=far[:,0]-own
+            zsum=far[:,1]+1j*far[:,2]-own*self.z
+        b=np.zeros(n)
+        localr=np.zeros(n)
+        has=count>.5
+        zmean=zsum[has]/count[has]
+        b[has]=(self.z[has].conjugate()*zmean).imag
+        localr[has]=abs(zmean)
+        self.localr[rows]=localr[rows]
+        return align[rows],seperate[rows],cohesion[rows],b[rows]
+
+    def runmesh(self,dt=.2,batches=4,paramalign=1,paramseperate=4,paramcohes=1):
+        # run() with a mesh. the boids move in `batches` groups, one after the
+        # other, each steering from the flock as the groups before it left
+        # it. run() goes one boid at a time; moving everyone at once
+        # (batches=1) loses that ordering, and without it the flock never lines up
+        self.z=np.exp(1j*self.phase)
+        for rows in np.array_split(np.arange(len(self.pos)),batches):
+            a,c,b,d=self.meshforces(rows)
+            self.frequency[rows]=1+d
+            acc=self.acc[rows]+a*paramalign+b*paramcohes+c*paramseperate
+            p=self.pos[rows]
+            p[p[:,0]>self.width,0]=0
+            p[p[:,0]<0,0]=self.width
+            p[p[:,1]>self.width,1]=0
+            p[p[:,1]<0,1]=self.height
+            vel=self.vel[rows]+acc*dt
+            speed=np.sqrt((vel**2).sum(axis=1))
+            over=speed>self.maxvel
+            vel[over]*=(self.maxvel/speed[over])[:,None]
+            self.vel[rows]=vel
+            self.phase[rows]+=self.frequency[rows]*dt
+            self.z[rows]=np.exp(1j*self.phase[rows])
+            self.pos[rows]=p+vel*dt
+            self.acc[rows]=0
+        self.r=abs(self.z.mean())
+        self.order.append(self.r)
+
+    def mesherror(self):
+        # how far the mesh is from the exact rules for the current state, per
+        # rule (align, seperate, cohesion, kuramoto): rms of the difference
+        # over rms of the exact value. seperate is exact and should come out
+        # ~0, and so should kuramoto while rku is below rv and rc
+        n=len(self.pos)
+        localr=self.localr.copy()
+        exact=[np.array(x,dtype=float) for x in zip(*(self.steering(i,range(n)) for i in range(n)))]
+        approx=self.meshforces()
+        self.localr[:]=localr
+        return [np.sqrt(((x-y)**2).mean()/max((x**2).mean(),1e-300)) for x,y in zip(exact,approx)]
 
     def cohesion(self, boids):
         P = np.zeros((len(boids),2))
@@ -164,37 +452,84 @@ class Flock:
         
 
             
-import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
-
-n=30
-flock = Flock(n)
-P = np.zeros((n,2))
-j=np.zeros((n,1))
-
-
-def update(*args):
-    flock.run()
-    for i,boid in enumerate(flock.boids):
-        P[i,1]=boid.position.x
-        P[i,0] = boid.position.y
-        print((i,boid.phase))
-    
-        
-    scatter.set_offsets(P)
-
-fig = plt.figure(figsize=(8, 5))
-ax = fig.add_axes([0.0, 0.0, 1.0, 1.0], frameon=True)
-scatter = ax.scatter(P[:,1], P[:,0],
-                     s=100, facecolor="blue", edgecolor="red", alpha=.7)
-
-animation = FuncAnimation(fig, update, interval=10)
-ax.set_xlim(0,640)
-ax.set_ylim(0,360)
-ax.set_xticks([])
-ax.set_yticks([])
-plt.show()
+class Clock:
+    # fixed-timestep clock for the live viewer: the flock should take `rate`
+    # steps per second of wall time whatever drawing costs. due() says how
+    # many steps a frame has to run to catch up; a backlog past `maxsub` is
+    # dropped instead, so a flock too big for real time just runs slower
+    def __init__(self,rate=100,maxsub=10):
+        self.rate=rate
+        self.maxsub=maxsub
+        self.last=time.perf_counter()
+        self.owed=0.0
+        self.steps=0
+        self.frames=0
+        self.dropped=0
+        self.mark=(self.last,0,0)
+        self.text=''
+
+    def due(self):
+        now=time.perf_counter()
+        self.owed+=(now-self.last)*self.rate
+        self.last=now
+        n=int(self.owed)
+        if n>self.maxsub:
+            self.dropped+=n-self.maxsub
+            n=self.maxsub
+            self.owed=0.0
+        else:
+            self.owed-=n
+        self.frames+=1
+        return n
+
+    def readout(self):
+        # steps/s and frames/s averaged over the last half second
+        now=time.perf_counter()
+        t,steps,frames=self.mark
+        if now-t>=.5:
+            self.text='%4.0f steps/s (target %d)  %3.0f fps  %d steps dropped'%(
+                (self.steps-steps)/(now-t),self.rate,(self.frames-frames)/(now-t),self.dropped)
+            self.mark=(now,self.steps,self.frames)
+        return self.text
+
+
+if __name__ == "__main__":
+    import numpy as np
+    import matplotlib.pyplot as plt
+    from matplotlib.animation import FuncAnimation
+
+    n=30
+    flock = Flock(n)
+    P = np.zeros((n,2))
+    j=np.zeros((n,1))
+
+    # real time: each drawn frame runs as many flock steps as the wall clock
+    # asks for (100 steps/s is what interval=10 was aiming at), not just one
+    clock=Clock(rate=100,maxsub=10)
+
+    def update(*args):
+        for _ in range(clock.due()):
+            flock.run()
+            clock.steps+=1
+        for i,phase in enumerate(flock.phase):
+            print((i,phase))
+        scatter.set_offsets(flock.pos[:,::-1])
+        readout.set_text(clock.readout())
+        return scatter,readout
+
+    fig = plt.figure(figsize=(8, 5))
+    ax = fig.add_axes([0.0, 0.0, 1.0, 1.0], frameon=True)
+    scatter = ax.scatter(P[:,1], P[:,0],
+                         s=100, facecolor="blue", edgecolor="red", alpha=.7)
+
+    readout=ax.text(.01,.98,'',transform=ax.transAxes,va='top',family='monospace',fontsize=9)
+
+    animation = FuncAnimation(fig, update, interval=10, blit=True, cache_frame_data=False)
+    ax.set_xlim(0,640)
+    ax.set_ylim(0,360)
+    ax.set_xticks([])
+    ax.set_yticks([])
+    plt.show()
 
 
 